@@ -0,0 +1,46 @@
+#!/usr/bin/env -S python -IS
+
+###############################################################################
+#   Thin client for a resident address book (addressbook.py --serve), which   #
+#  avoids paying the startup costs of the full script on every keystroke. If  #
+#     no server is running (or it cannot handle a request), it falls back     #
+#                     to executing addressbook.py directly.                   #
+###############################################################################
+
+from json import dumps, loads
+from os import environ, execv
+from os.path import dirname, join, realpath
+from socket import AF_UNIX, socket
+from sys import argv, exit, stderr, stdin, stdout
+
+ADDRESS_SOCKET = join(environ.get("XDG_RUNTIME_DIR", "/tmp"), "aerc-addressbook.sock")
+ADDRESS_BOOK_CMD = join(dirname(realpath(__file__)), "addressbook.py")
+# seconds to wait for a busy server before running addressbook.py directly
+TIMEOUT = 0.5
+
+
+def request(args):
+    with socket(AF_UNIX) as sock:
+        sock.settimeout(TIMEOUT)
+        sock.connect(ADDRESS_SOCKET)
+        sock.sendall(dumps(args).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            return loads(f.read())
+
+
+if __name__ == "__main__":
+    # when used as a filter, register the sender and pass the message through
+    args = argv[1:] or (["--add", environ["AERC_FROM"]] if "AERC_FROM" in environ else [])
+
+    try:
+        response = request(args)
+    except (OSError, ValueError):
+        response = dict(status=None)
+    if response["status"] is None:
+        execv(ADDRESS_BOOK_CMD, [ADDRESS_BOOK_CMD, *argv[1:]])
+
+    stdout.write(response["stdout"])
+    stderr.write(response["stderr"])
+    if not argv[1:]:
+        print(stdin.read())
+    exit(response["status"] if argv[1:] else 0)
@@ -5,54 +5,425 @@
 ###############################################################################
 
 from argparse import ArgumentParser
-from email.utils import parseaddr
-from logging import error, warning
-from os import getenv
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from email.parser import BytesHeaderParser
+from email.utils import formataddr, getaddresses, parseaddr
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from io import StringIO
+from json import dumps, loads
+from logging import StreamHandler, basicConfig, error, warning
+from os import fstat, fsync, getenv, replace, umask
 from pathlib import Path
-from re import escape, search
+from random import uniform
+from re import compile, escape, search, split
+from shutil import copymode
+from socketserver import StreamRequestHandler, UnixStreamServer
+from sqlite3 import connect
 from sys import stdin, exit
+from tempfile import NamedTemporaryFile
+from time import sleep, time
 
 ADDRESS_BOOK = Path(getenv("XDG_CONFIG_HOME", Path.home())) / ".config/aerc/addressbook.tsv"
+ADDRESS_INDEX = Path(getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / "aerc/addressbook.db"
+ADDRESS_SOCKET = Path(getenv("XDG_RUNTIME_DIR", "/tmp")) / "aerc-addressbook.sock"
+LOCK_TIMEOUT = 10
+# rewrite the address book once this fraction of its rows is dead
+COMPACT_RATIO = 0.25
 
 
-def match_addr(addr, content):
-    return search(rf'\b{escape(addr)}\t', content) is not None
+def fold(content):
+    """
+    Apply the tombstones ("-\t<email>" rows) of removals to the content of an
+    address book and return the live content with the number of dead rows.
+    """
+    if not content.startswith("-\t") and "\n-\t" not in content:
+        return content, 0
+    lines, removed = content.splitlines(True), {}
+    for idx, line in enumerate(lines):
+        if line.startswith("-\t"):
+            removed[line[2:].rstrip("\n")] = idx
+    live = [line for idx, line in enumerate(lines) if idx > removed.get(line.partition("\t")[0], -1) and line[:2] != "-\t"]
+    return "".join(live), len(lines) - len(live)
 
 
-def iter_addrs(pattern):
-    for line in ADDRESS_BOOK.read_text().splitlines():
-        if pattern.lower() in line.lower():
+def words(line):
+    """Casefolded words of a line, each prefixed with a space for word-prefix tests."""
+    return " " + " ".join(split(r"[\W_]+", line.casefold()))
+
+
+class AddressBook:
+    """
+    Plain address book which scans the tsv file on every lookup. Matches which
+    start at a word boundary rank first, followed by recently added addresses.
+    Writers have to hold the lock, readers never block since the file is only
+    appended to or atomically replaced. Removals append tombstones, and the
+    file is only compacted once too many of its rows are dead. The content is
+    kept in memory and only read again when the file changed.
+    """
+
+    def __init__(self, path=ADDRESS_BOOK):
+        self.path, self.stat = path, None
+        self.path.touch(exist_ok=True)
+        self.sync()
+
+    def sync(self):
+        """Reload the tsv file if it changed since the last sync."""
+        with self.path.open() as f:
+            stat = fstat(f.fileno())
+            if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != self.stat:
+                content, self.folded = f.read(), None
+                self.content, self.dead = fold(content)
+                self.total = content.count("\n")
+                self.stat = stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @contextmanager
+    def lock(self, timeout=LOCK_TIMEOUT):
+        """Exclusively lock the address book, retrying with randomized exponential backoff."""
+        with self.path.with_suffix(".lock").open("a") as f:
+            delay, deadline = 0.001, time() + timeout
+            while True:
+                try:
+                    flock(f, LOCK_EX | LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time() > deadline:
+                        raise TimeoutError(f"Could not lock {self.path} within {timeout} seconds.")
+                    sleep(uniform(0, delay := min(2 * delay, 0.1)))
+            try:
+                self.sync()
+                yield
+            finally:
+                flock(f, LOCK_UN)
+
+    def __contains__(self, email):
+        return search(rf"(?m)^{escape(email)}\t", self.content) is not None
+
+    def search(self, pattern, limit=None):
+        if self.folded is None:
+            self.folded = list(zip(self.content.splitlines(), self.content.casefold().splitlines()))
+        pattern, hits = pattern.casefold(), []
+        prefix = compile(rf"(?<![^\W_]){escape(pattern)}")
+        for pos, (line, folded) in enumerate(self.folded):
+            if pattern in folded:
+                hits.append((not prefix.search(folded), -pos, line))
+        for *_, line in sorted(hits)[:limit]:
             yield line
 
+    def emails(self):
+        return {line.partition("\t")[0] for line in self.content.splitlines()}
+
+    def seen(self, email):
+        """Record that an existing email was seen again (no-op without an index)."""
+
+    def add(self, email, name):
+        self.extend([(email, name)])
+
+    def extend(self, rows):
+        with self.path.open("a") as f:
+            f.write("".join(f"{email}\t{name}\n" for email, name in rows))
+
+    def remove(self, email):
+        with self.path.open("a") as f:
+            f.write(f"-\t{email}\n")
+        self.sync()
+        if self.dead > COMPACT_RATIO * self.total:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the address book without dead rows."""
+        self.rewrite(fold(self.path.read_text())[0])
+        self.sync()
+
+    def rewrite(self, content):
+        """Atomically replace the address book through a temporary file."""
+        with NamedTemporaryFile("w", dir=self.path.parent, prefix=".addressbook.", delete=False) as f:
+            f.write(content)
+            f.flush()
+            fsync(f.fileno())
+        copymode(self.path, f.name)
+        replace(f.name, self.path)
+
+
+class IndexedAddressBook(AddressBook):
+    """
+    Address book backed by an SQLite index, which provides exact email lookups
+    through a b-tree and substring search through an FTS5 trigram index (or
+    through a b-tree of words for patterns which are too short for trigrams). The
+    tsv file stays the source of truth: appended rows (e.g., from instances
+    without an index) are synced incrementally, any other change to the file
+    triggers a rebuild. Additionally, the index counts how often and when an
+    address was seen to rank frequently and recently used addresses first.
+    """
+    version = 2
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value);
+        CREATE TABLE IF NOT EXISTS addrs(
+            id INTEGER PRIMARY KEY, email TEXT UNIQUE, name TEXT, words TEXT,
+            count INTEGER DEFAULT 1, seen REAL DEFAULT 0
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS grams USING fts5(
+            email, name, content='addrs', content_rowid='id', tokenize='trigram'
+        );
+        CREATE TABLE IF NOT EXISTS tokens(token TEXT, id INTEGER);
+        CREATE INDEX IF NOT EXISTS tokens_idx ON tokens(token);
+    """
+    # bytes before the synced offset which must be unchanged for an incremental sync
+    tail = 64
+
+    def __init__(self, path=ADDRESS_BOOK, index=ADDRESS_INDEX):
+        index.parent.mkdir(parents=True, exist_ok=True)
+        self.db = connect(index, timeout=LOCK_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            self.db.executescript(
+                "DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS addrs; "
+                "DROP TABLE IF EXISTS grams; DROP TABLE IF EXISTS tokens;"
+            )
+            self.db.execute(f"PRAGMA user_version = {self.version}")
+        self.db.executescript(self.schema)
+        super().__init__(path)
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, **values):
+        self.db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", values.items())
+
+    def sync(self):
+        with self.db:
+            # serialize syncs before opening the file, so that no stale copy gets indexed
+            self.db.execute("BEGIN IMMEDIATE")
+            with self.path.open("rb") as f:
+                inode, offset = fstat(f.fileno()).st_ino, self.get_meta("offset", 0)
+                f.seek(start := max(offset - self.tail, 0))
+                tail = f.read(offset - start)
+                if stale := inode != self.get_meta("inode") or tail != self.get_meta("tail", b""):
+                    # keep usage statistics of addresses which survive the rebuild
+                    stats = self.db.execute("SELECT count, seen, email FROM addrs WHERE count > 1 OR seen > 0").fetchall()
+                    self.db.execute("DELETE FROM addrs")
+                    self.db.execute("INSERT INTO grams(grams) VALUES ('delete-all')")
+                    self.db.execute("DELETE FROM tokens")
+                    f.seek(offset := 0)
+                if (content := f.read()) or stale:
+                    content = content[:content.rfind(b"\n") + 1]
+                    dead = self.insert(line.partition("\t")[::2] for line in content.decode().splitlines())
+                    if stale:
+                        self.db.executemany("UPDATE addrs SET count = ?, seen = ? WHERE email = ?", stats)
+                    else:
+                        dead += self.dead
+                    f.seek(start := max((offset := offset + len(content)) - self.tail, 0))
+                    self.set_meta(inode=inode, offset=offset, tail=f.read(offset - start), dead=dead)
 
-def add_addr(addr, verbose=False):
+    @property
+    def dead(self):
+        return self.get_meta("dead", 0)
+
+    @property
+    def total(self):
+        return self.db.execute("SELECT count(*) FROM addrs").fetchone()[0] + self.dead
+
+    def insert(self, rows):
+        """Index rows in file order, applying tombstones, and return the number of dead rows."""
+        dead, added = 0, []
+        for email, name in rows:
+            if email == "-":
+                self.index(added)
+                dead, added = dead + 1 + self.unindex(name), []
+            else:
+                added.append((email, name))
+        self.index(added)
+        return dead
+
+    def unindex(self, email):
+        if row := self.db.execute("SELECT id, email, name FROM addrs WHERE email = ?", (email,)).fetchone():
+            self.db.execute("INSERT INTO grams(grams, rowid, email, name) VALUES ('delete', ?, ?, ?)", row)
+            self.db.execute("DELETE FROM tokens WHERE id = ?", row[:1])
+            self.db.execute("DELETE FROM addrs WHERE id = ?", row[:1])
+        return row is not None
+
+    def index(self, rows):
+        last = self.db.execute("SELECT ifnull(max(id), 0) FROM addrs").fetchone()[0]
+        self.db.executemany(
+            "INSERT OR IGNORE INTO addrs(email, name, words) VALUES (?, ?, ?)",
+            ((email, name, words(f"{email} {name}")) for email, name in rows)
+        )
+        self.db.execute(
+            "INSERT INTO grams(rowid, email, name) SELECT id, email, name FROM addrs WHERE id > ?",
+            (last,)
+        )
+        self.db.executemany(
+            "INSERT INTO tokens VALUES (?, ?)",
+            ((token, id_) for id_, words_ in self.db.execute("SELECT id, words FROM addrs WHERE id > ?", (last,))
+                for token in set(words_.split()))
+        )
+
+    def __contains__(self, email):
+        return self.db.execute("SELECT 1 FROM addrs WHERE email = ?", (email,)).fetchone() is not None
+
+    def search(self, pattern, limit=None):
+        if len(pattern) >= 3:
+            where, args = "id IN (SELECT rowid FROM grams WHERE grams MATCH ?)", ['"' + pattern.replace('"', '""') + '"']
+        elif pattern := pattern.casefold():
+            # trigrams need at least three characters, so only match word prefixes
+            where, args = "id IN (SELECT id FROM tokens WHERE token >= ? AND token < ?)", [pattern, pattern + "\U0010ffff"]
+        else:
+            where, args = "1", []
+        query = f"""
+            SELECT email, name FROM addrs WHERE {where}
+            ORDER BY instr(words, ?) = 0, count DESC, seen DESC, id DESC LIMIT ?
+        """
+        for email, name in self.db.execute(query, (*args, f" {pattern.casefold()}", limit or -1)):
+            yield f"{email}\t{name}"
+
+    def emails(self):
+        return {email for email, in self.db.execute("SELECT email FROM addrs")}
+
+    def seen(self, email):
+        with self.db:
+            self.db.execute("UPDATE addrs SET count = count + 1, seen = ? WHERE email = ?", (time(), email))
+
+    def extend(self, rows):
+        super().extend(rows := list(rows))
+        self.sync()
+        with self.db:
+            self.db.executemany("UPDATE addrs SET seen = ? WHERE email = ?", ((time(), email) for email, _ in rows))
+
+
+def open_book(indexed=False):
+    return IndexedAddressBook() if indexed else AddressBook()
+
+
+def iter_addrs(pattern, limit=None, book=None):
+    yield from (book or open_book()).search(pattern, limit)
+
+
+def parse_addr(addr):
     name, email = parseaddr(addr, strict=False)
-    name = " ".join(reversed(name.split(",", 1)))
+    return " ".join(reversed(name.split(",", 1))), email
+
+
+def is_noreply(email):
+    return search(r'no.?reply', email.lower()) is not None
+
+
+def read_header(f):
+    """Read the header block of a message from a binary file up to the first empty line."""
+    return b"".join(iter(lambda: (line := f.readline()).strip() and line, b""))
+
+
+def iter_headers(path):
+    """Yield the header blocks of all messages in a Maildir tree or an mbox file."""
+    if path.is_dir():
+        for file in path.rglob("*"):
+            if file.parent.name in ("cur", "new") and file.is_file():
+                with file.open("rb") as f:
+                    yield read_header(f)
+    else:
+        with path.open("rb") as f:
+            for line in f:
+                if line.startswith(b"From "):
+                    yield read_header(f)
+
+
+def iter_import(sources):
+    """Yield the sender addresses from stdin ("-", one address per line), mbox files or Maildirs."""
+    parser = BytesHeaderParser()
+    for source in sources:
+        if source == "-":
+            yield from filter(None, map(str.strip, stdin))
+        else:
+            for header in iter_headers(Path(source)):
+                for name, email in getaddresses(parser.parsebytes(header).get_all("From", [])):
+                    yield formataddr((name, email))
+
+
+def add_addr(addr, verbose=False, book=None):
+    book = book or open_book()
+    name, email = parse_addr(addr)
 
     if name + email:
-        if search(r'no.?reply', email.lower()):
+        if is_noreply(email):
             if verbose:
                 warning("Skipping noreply address.")
-        elif not match_addr(email, ADDRESS_BOOK.read_text()):
-            with ADDRESS_BOOK.open("a") as f:
-                f.write(f"{email}\t{name}\n")
-        elif verbose:
-            warning("Email already exists, skipping.")
+        else:
+            with book.lock():
+                if email not in book:
+                    book.add(email, name)
+                    return
+                book.seen(email)
+            if verbose:
+                warning("Email already exists, skipping.")
     else:
         error("Address is not a RFC 5322 compliant string!")
         return 1
 
 
-def remove_addr(addr, verbose=False):
-    if match_addr(addr, content:=ADDRESS_BOOK.read_text()):
-        lines = [line for line in content.splitlines(True) if not match_addr(addr, line)]
-        ADDRESS_BOOK.write_text("".join(lines))
-    elif verbose:
+def import_addrs(sources, verbose=False, book=None):
+    book, addrs = book or open_book(), {}
+
+    for addr in iter_import(sources):
+        name, email = parse_addr(addr)
+        if email and not is_noreply(email):
+            addrs.setdefault(email, name)
+
+    with book.lock():
+        known = book.emails()
+        book.extend(rows := [(email, name) for email, name in addrs.items() if email not in known])
+    if verbose:
+        warning(f"Imported {len(rows)} new addresses.")
+
+
+def compact_book(verbose=False, book=None):
+    with (book := book or open_book()).lock():
+        dead = book.dead
+        book.compact()
+    if verbose:
+        warning(f"Removed {dead} dead rows.")
+
+
+def remove_addr(addr, verbose=False, book=None):
+    with (book := book or open_book()).lock():
+        if addr in book:
+            book.remove(addr)
+            return
+    if verbose:
         error("Email does not exist!")
         return 1
 
 
-def parse_args():
+def serve(book, path=ADDRESS_SOCKET):
+    """
+    Keep the address book resident and serve the command line interface of
+    this script over a unix socket (see addressbook-client.py). Each request is
+    a JSON list of arguments, each response a JSON object with the exit
+    status and the captured output (a null status means unsupported request).
+    """
+    basicConfig(handlers=[log := StreamHandler()])
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            status = None
+            with redirect_stdout(stdout := StringIO()), redirect_stderr(StringIO()):
+                try:
+                    args = parse_args(loads(self.rfile.readline()))
+                except SystemExit:
+                    # unsupported, the client runs the script itself which reports usage errors
+                    args = None
+                log.setStream(stderr := StringIO())
+                if args and (args.match or args.add or args.remove):
+                    book.sync()
+                    status = run(args, book) or 0
+            response = dict(status=status, stdout=stdout.getvalue(), stderr=stderr.getvalue())
+            self.wfile.write(dumps(response).encode())
+
+    path.unlink(missing_ok=True)
+    umask(0o077)
+    with UnixStreamServer(str(path), Handler) as server:
+        server.serve_forever()
+
+
+def parse_args(argv=None):
     parser = ArgumentParser(
         description="Minimalistic address book for the aerc email client."
     )
@@ -60,6 +431,14 @@ def parse_args():
         action="store_true",
         help="Enable verbose logging.",
     )
+    parser.add_argument("--index",
+        action="store_true",
+        help="Use an SQLite index for fast lookups in large address books.",
+    )
+    parser.add_argument("--limit",
+        type=int,
+        help="Only print the best LIMIT matches.",
+    )
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
@@ -70,24 +449,52 @@ def parse_args():
         "--add",
         help="Manually add an address as an RFC 5322 compliant string.",
     )
+    group.add_argument(
+        "--import",
+        dest="sources",
+        metavar="SOURCE",
+        nargs="+",
+        help="Import senders from mbox files, Maildirs, or stdin (-) with one address per line.",
+    )
     group.add_argument(
         "--remove",
         help="Remove an email from the addressbook.",
     )
+    group.add_argument(
+        "--compact",
+        action="store_true",
+        help="Rewrite the addressbook without the rows of removed emails.",
+    )
+    group.add_argument(
+        "--serve",
+        action="store_true",
+        help="Serve requests from addressbook-client.py over a unix socket.",
+    )
 
-    return parser.parse_args()
-
+    return parser.parse_args(argv)
 
-if __name__ == "__main__":
-    ADDRESS_BOOK.touch(exist_ok=True)
-    args = parse_args()
 
+def run(args, book):
     if args.match:
-        print(*iter_addrs(args.match), sep="\n")
+        print(*iter_addrs(args.match, args.limit, book), sep="\n")
     elif args.add:
-        exit(add_addr(args.add, verbose=args.verbose))
+        return add_addr(args.add, verbose=args.verbose, book=book)
+    elif args.sources:
+        import_addrs(args.sources, verbose=args.verbose, book=book)
     elif args.remove:
-        exit(remove_addr(args.remove, verbose=args.verbose))
+        return remove_addr(args.remove, verbose=args.verbose, book=book)
+    elif args.compact:
+        compact_book(verbose=args.verbose, book=book)
+    elif args.serve:
+        serve(book)
     elif addr:=getenv("AERC_FROM"):
-        add_addr(addr, args.verbose)
+        try:
+            add_addr(addr, args.verbose, book)
+        except TimeoutError as e:
+            error(e)
         print(stdin.read())
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    exit(run(args, open_book(args.index)))
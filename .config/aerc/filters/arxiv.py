@@ -5,31 +5,309 @@
 #                                  interest.                                  #
 ###############################################################################
 
-from sys import stdin
-
-KEYWORDS = [
-    "code generation",
-    "document understanding",
-    "graphics program",
-    "inverse graphics",
-    "procedural material",
-    "program synthesis",
-    "LaTeX",
-    "vector graphics",
-    "LMM",
-    "MLLM",
-    "multimodal",
-    "optical character recognition"
-    "perceptual similarity",
-    "poetry",
-    "scientific document"
-    "scientific figure"
-    "TikZ",
-    "vectorization",
-    "vision language model",
-    "VLLM",
-    "VLM",
-]
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from email import message_from_binary_file
+from email.policy import default
+from fcntl import LOCK_EX, flock
+from hashlib import sha1, sha256
+from itertools import chain, islice, repeat
+from os import cpu_count, getenv, replace
+from os.path import abspath, commonpath
+from pathlib import Path
+from pickle import dump, load
+from re import compile, escape, fullmatch, search
+from sys import exit, stderr, stdin, stdout
+from tempfile import NamedTemporaryFile
+from time import time
+
+
+class Rule:
+    """A keyword which is optionally scoped to certain fields of a paper and weighted."""
+    __slots__ = ("keyword", "fields", "weight")
+
+    def __init__(self, keyword, fields=None, weight=1):
+        self.keyword, self.fields, self.weight = keyword, fields, weight
+
+
+KEYWORDS = Path(getenv("XDG_CONFIG_HOME", Path.home() / ".config")) / "aerc/arxiv-keywords"
+KEYWORDS_CACHE = Path(getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / "aerc/arxiv-keywords.pickle"
+# minimum score a paper needs to pass the filter
+THRESHOLD = 1
+SEEN_CACHE = Path(getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / "aerc/arxiv-seen.tsv"
+SEEN_MAX_AGE = 60 * 24 * 60 * 60
+SEEN_MAX_SIZE = 10_000
+
+
+def trie_regex(node):
+    alternatives = [escape(char) + trie_regex(child) for char, child in sorted(node.items()) if char]
+    if not alternatives:
+        return ""
+    group = alternatives[0] if len(alternatives) == 1 else f"(?:{'|'.join(alternatives)})"
+    return f"(?:{group})?" if "" in node else group
+
+
+def compile_keywords(keywords):
+    """
+    Compile keywords into a single regex shaped like a trie (e.g., "vlm" and
+    "vllm" become "vl(?:lm|m)"), so that a paper can be matched against all
+    keywords in a single pass without backtracking over common prefixes.
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword.lower():
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return compile(trie_regex(trie) if trie else "(?!)")
+
+
+class Paper:
+    """
+    A single paper entry of an arXiv mail. Its fields are parsed once on first
+    access, so papers which are only matched as a whole are never parsed.
+    """
+    __slots__ = ("text", "score", "id", "version", "title", "authors", "categories", "comments", "abstract")
+
+    def __init__(self, text):
+        self.text, self.score = text, 0
+
+    def __getattr__(self, name):
+        if name in self.__slots__:
+            self.parse()
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def parse(self):
+        fields = defaultdict(str)
+        head, _, abstract = self.text.removeprefix("\\\\\n").partition("\n\\\\\n")
+
+        key = None
+        for line in head.splitlines():
+            if line.startswith("arXiv:"):
+                key, fields["id"] = None, line.removeprefix("arXiv:").split()[0]
+            elif line[:1].isspace() and key:
+                fields[key] += line
+            elif line:
+                key, _, value = line.partition(": ")
+                key = key.lower()
+                fields[key] = value
+
+        # e.g., "Date (revised v2): ..." or "Date: ... (this version, v3))", replacements
+        # without an explicit version are told apart by the date they were replaced on
+        if match := search(r"(?m)^Date \(revised v(\d+)\)|\(this version, v(\d+)\)", head):
+            self.version = match.group(1) or match.group(2)
+        elif match := search(r"(?m)^replaced with revised version (.*?) *\(", head):
+            self.version = match.group(1)
+        else:
+            self.version = "1"
+        self.id, self.title, self.authors = fields["id"], fields["title"], fields["authors"]
+        self.categories, self.comments = fields["categories"], fields["comments"]
+        self.abstract = abstract.partition("\n\\\\ (")[0]
+
+    def normalized(self, field):
+        """Whitespace-normalized, lowercase content of a field (or of the whole entry for "text")."""
+        return " ".join(getattr(self, field).split()).lower()
+
+    def __str__(self):
+        return self.text
+
+
+class Matcher:
+    """
+    Score papers according to rules. Rules are grouped by field, and the
+    keywords of each field are compiled into a single regex. Fields are
+    searched from the cheapest to the most expensive one, so that scoring can
+    stop early once a paper is known to pass (i.e., once no negative weights
+    remain in the fields left to search). Unscoped rules match the whole
+    entry. Keywords are found even if they overlap with or are nested in other
+    keywords.
+    """
+    fields = ("id", "categories", "title", "authors", "comments", "abstract", "text")
+
+    def __init__(self, rules):
+        weights = defaultdict(lambda: defaultdict(int))
+        for rule in rules:
+            rule = rule if isinstance(rule, Rule) else Rule(rule)
+            for field in rule.fields or ["text"]:
+                weights[field][rule.keyword.lower()] += rule.weight
+        self.rules = [
+            (field, compile_keywords(weights[field]), weights[field], self.prefixes(weights[field]))
+            for field in self.fields if field in weights
+        ]
+        # scoring may only stop early after the last field with a negative weight
+        self.stop = max(
+            (idx for idx, (_, _, weights, _) in enumerate(self.rules) if min(weights.values()) < 0), default=0
+        )
+
+    @staticmethod
+    def prefixes(keywords):
+        """Map each keyword to all keywords which are a prefix of it (including itself)."""
+        return {keyword: tuple(prefix for prefix in keywords if keyword.startswith(prefix)) for keyword in keywords}
+
+    @staticmethod
+    def find(pattern, prefixes, text):
+        """
+        Distinct keywords which occur in a text. The regex matches the longest
+        keyword at a position, so the search is resumed right after where the
+        last match started and shorter keywords are taken from its prefixes.
+        """
+        hits, match = set(), pattern.search(text)
+        while match:
+            hits.update(prefixes[match.group()])
+            match = pattern.search(text, match.start() + 1)
+        return hits
+
+    def score(self, paper, threshold=None):
+        score = 0
+        for idx, (field, pattern, weights, prefixes) in enumerate(self.rules):
+            score += sum(weights[hit] for hit in self.find(pattern, prefixes, paper.normalized(field)))
+            if threshold is not None and score >= threshold and idx >= self.stop:
+                break
+        return score
+
+    def hits(self, paper):
+        """All keywords which occur in a paper, without stopping early."""
+        return {
+            hit for field, pattern, _, prefixes in self.rules
+            for hit in self.find(pattern, prefixes, paper.normalized(field))
+        }
+
+
+class SeenCache:
+    """
+    Papers which were already delivered, keyed by arXiv id and version. Each
+    entry remembers the digest it was delivered in (so that the same digest
+    can be viewed again) and when, so that expired entries and the oldest
+    entries beyond the size limit can be evicted. If the cache can't be used,
+    no papers are skipped.
+    """
+    def __init__(self, path=SEEN_CACHE, max_age=SEEN_MAX_AGE, max_size=SEEN_MAX_SIZE):
+        self.path, self.max_age, self.max_size = path, max_age, max_size
+        self.entries = {}
+
+    def __enter__(self):
+        self.lock = None
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            lock = open(self.path.with_suffix(".lock"), "w")
+            try:
+                flock(lock, LOCK_EX)
+            except OSError:
+                lock.close()
+                raise
+            self.lock = lock
+        except OSError as e:
+            print(f"Not skipping seen papers: {e}", file=stderr)
+            return self
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    key, digest, stamp = line.rstrip("\n").split("\t")
+                    self.entries[key] = digest, float(stamp)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable seen cache: {e}", file=stderr)
+        return self
+
+    def __exit__(self, *_):
+        if self.lock is None:
+            return
+        try:
+            self.save()
+        except OSError as e:
+            print(f"Could not save seen cache: {e}", file=stderr)
+        finally:
+            self.lock.close()
+
+    def __contains__(self, item):
+        paper, digest = item
+        return (entry := self.entries.get(f"{paper.id} v{paper.version}")) is not None and entry[0] != digest
+
+    def add(self, paper, digest):
+        if paper.id:
+            self.entries.setdefault(f"{paper.id} v{paper.version}", (digest, time()))
+
+    def save(self):
+        # entries are kept in the order they were added, i.e., oldest first
+        now = time()
+        entries = [(key, entry) for key, entry in self.entries.items() if now - entry[1] < self.max_age]
+        with NamedTemporaryFile("w", dir=self.path.parent, prefix=".arxiv-seen.", delete=False) as f:
+            f.writelines(f"{key}\t{digest}\t{stamp}\n" for key, (digest, stamp) in islice(entries, max(len(entries) - self.max_size, 0), None))
+        replace(f.name, self.path)
+
+
+def load_rules(path):
+    """
+    Parse and validate a keywords file with one "[field,...:] keyword [^weight]"
+    rule per line.
+    """
+    rules, seen = [], set()
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            if not (line := line.strip()) or line.startswith("#"):
+                continue
+            if not (match := fullmatch(r"(?:([\w\s,]+):)?\s*(.*?)(?:\s*\^\s*(\S+))?", line)):
+                raise ValueError(f"{path}:{lineno}: invalid rule: {line}")
+            fields, keyword, weight = match.groups()
+            if not (keyword := " ".join(keyword.split())):
+                raise ValueError(f"{path}:{lineno}: missing keyword")
+            if fields is not None:
+                fields = tuple(field.strip() for field in fields.split(","))
+                if unknown := set(fields) - set(Matcher.fields):
+                    raise ValueError(f"{path}:{lineno}: unknown fields: {', '.join(sorted(unknown))}")
+            try:
+                weight = float(weight or 1)
+                weight = int(weight) if weight.is_integer() else weight
+            except ValueError:
+                raise ValueError(f"{path}:{lineno}: invalid weight: {weight}")
+            if (key := (keyword.lower(), fields)) in seen:
+                raise ValueError(f"{path}:{lineno}: duplicate keyword: {keyword}")
+            seen.add(key)
+            rules.append(Rule(keyword, fields, weight))
+    return rules
+
+
+def load_matcher(path=KEYWORDS, cache=KEYWORDS_CACHE):
+    """
+    Load a keywords file into a Matcher. The matcher is pickled together with
+    a hash of the keywords file (and of this script, as the pickle depends on
+    its code), so that it is only rebuilt when either of them changes.
+    """
+    key = sha256(path.read_bytes() + Path(__file__).read_bytes()).hexdigest()
+    try:
+        with open(cache, "rb") as f:
+            cached_key, matcher = load(f)
+        if cached_key == key:
+            return matcher
+    except Exception: # missing, outdated or corrupt cache
+        pass
+
+    matcher = Matcher(load_rules(path))
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        with NamedTemporaryFile("wb", dir=cache.parent, prefix=".arxiv-keywords.", delete=False) as f:
+            dump((key, matcher), f)
+        replace(f.name, cache)
+    except OSError as e:
+        print(f"Could not cache keywords: {e}", file=stderr)
+    return matcher
+
+
+def iter_chunks(lines, sep):
+    """Lazily split an iterable of lines at a separator which ends with a newline."""
+    chunk = []
+    for line in lines:
+        if line.endswith(sep):
+            chunk.append(line[:-len(sep)])
+            yield "".join(chunk)
+            chunk = []
+        else:
+            chunk.append(line)
+    yield "".join(chunk)
 
 
 class ArxivMail:
@@ -37,31 +315,223 @@ class ArxivMail:
     header_sep = 2 * sep
     footer = 13 * "%%%---"
 
-    def __init__(self, mail=None, header=None, papers=None, filtered=0):
-        self.filtered = filtered
+    def __init__(self, mail=None, header=None, papers=None, filtered=0, seen=0, ranked=False):
+        self.filtered, self.seen, self.ranked = filtered, seen, ranked
         if mail is not None:
             self.header, _, self.papers = mail.rpartition(self.header_sep)
-            self.papers = self.papers.rstrip(self.footer).split(self.sep)
-        self.header = header or self.header
-        self.papers = papers or self.papers
-
-    def filter(self, keywords):
-        filtered_papers = [
-            paper
-            for paper in self.papers
-            if any(key.lower() in " ".join(paper.split()).lower() for key in keywords)
-        ]
+            self.papers = [Paper(paper) for paper in self.papers.rstrip(self.footer).split(self.sep)]
+        self.header = self.header if header is None else header
+        self.papers = self.papers if papers is None else papers
+
+    @staticmethod
+    def digest(header):
+        return sha1(header.encode()).hexdigest()
+
+    def filter(self, keywords, threshold=THRESHOLD, rank=False, seen=None):
+        matcher = keywords if isinstance(keywords, Matcher) else Matcher(keywords)
+        papers, digest = self.papers, self.digest(self.header)
+        if seen is not None:
+            papers = [paper for paper in papers if (paper, digest) not in seen]
+        for paper in papers:
+            paper.score = matcher.score(paper, threshold)
+        filtered_papers = [paper for paper in papers if paper.score >= threshold]
+        if seen is not None:
+            for paper in filtered_papers:
+                seen.add(paper, digest)
+        if rank:
+            for paper in filtered_papers:
+                paper.score = matcher.score(paper)
+            filtered_papers.sort(key=lambda paper: paper.score, reverse=True)
         return ArxivMail(
             header=self.header,
             papers=filtered_papers,
-            filtered=self.filtered + len(self.papers) - len(filtered_papers),
+            filtered=self.filtered + len(papers) - len(filtered_papers),
+            seen=self.seen + len(self.papers) - len(papers),
+            ranked=rank,
         )
 
+    @classmethod
+    def stream(cls, lines, keywords, out=stdout, threshold=THRESHOLD, seen=None):
+        """
+        Filter a mail incrementally and write matching papers as soon as they
+        are delimited, so that memory is bounded by the size of a single paper.
+        Since the number of filtered papers is only known at the end, the
+        summary is written after the last paper instead of into the header.
+        """
+        matcher = keywords if isinstance(keywords, Matcher) else Matcher(keywords)
+        chunks = iter_chunks(lines, cls.sep)
+        head, filtered, skipped, first = [], 0, 0, True
+
+        # the header ends with the last header separator before the first paper
+        for chunk in chunks:
+            head.append(chunk)
+            if chunk.startswith("\\\\"):
+                break
+        split = max((idx for idx, chunk in enumerate(head[:-1]) if not chunk), default=-1)
+        header = cls.sep.join(head[:max(split, 0)])
+        out.write(header + cls.header_sep)
+        digest = cls.digest(header)
+
+        papers = chain(head[split + 1:], chunks)
+        paper = next(papers)
+        while paper is not None:
+            if (following := next(papers, None)) is None:
+                paper = paper.rstrip(cls.footer)
+            if seen is not None and (Paper(paper), digest) in seen:
+                skipped += 1
+            elif matcher.score(parsed := Paper(paper), threshold) >= threshold:
+                out.write(paper if first else cls.sep + paper)
+                out.flush()
+                first = False
+                if seen is not None:
+                    seen.add(parsed, digest)
+            else:
+                filtered += 1
+            paper = following
+
+        out.write(f"{cls.sep}{cls.summary(filtered, skipped)}{cls.footer}\n")
+
+    @staticmethod
+    def summary(filtered, seen):
+        return f"Filtered {filtered} papers ({seen} seen before).\n" if seen else f"Filtered {filtered} papers.\n"
+
     def __repr__(self):
-        papers = self.sep.join(self.papers)
-        header = self.sep.join([self.header, f"Filtered {self.filtered} papers.\n"])
+        if self.ranked:
+            papers = self.sep.join(f"Relevance: {paper.score}\n{paper}" for paper in self.papers)
+        else:
+            papers = self.sep.join(map(str, self.papers))
+        header = self.sep.join([self.header, self.summary(self.filtered, self.seen)])
         return "".join([header, self.header_sep, papers, self.footer])
 
 
+# compiled once in each worker process of a batch run
+MATCHER = None
+
+
+def init_worker(matcher):
+    global MATCHER
+    MATCHER = matcher
+
+
+def read_digest(path):
+    """Text of a digest which is either stored as a mail (e.g., in a Maildir) or as plain text."""
+    with open(path, "rb") as f:
+        mail = message_from_binary_file(f, policy=default)
+    if "From" in mail and (body := mail.get_body(("plain",))) is not None:
+        return body.get_content()
+    return path.read_text(errors="replace")
+
+
+def filter_digest(path, output=None):
+    text = read_digest(path)
+    if ArxivMail.header_sep not in text:
+        return None
+    mail = ArxivMail(text)
+    filtered = mail.filter(MATCHER)
+    if output is not None:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(f"{filtered}\n")
+    hits = Counter(hit for paper in filtered.papers for hit in MATCHER.hits(paper))
+    return len(mail.papers), len(filtered.papers), hits
+
+
+def iter_digests(paths):
+    for path in map(Path, paths):
+        if (path / "cur").is_dir() or (path / "new").is_dir():
+            subdirs = [path / sub for sub in ("cur", "new") if (path / sub).is_dir()]
+            yield from sorted(file for sub in subdirs for file in sub.iterdir() if file.is_file())
+        elif path.is_dir():
+            yield from sorted(file for file in path.iterdir() if file.is_file())
+        else:
+            yield path
+
+
+def batch(paths, keywords, output=None, jobs=None):
+    """
+    Re-filter archived digests in parallel. Each worker compiles the keywords
+    only once, and only paper counts and keyword hits are sent back to be
+    aggregated into a report. Filtered digests are written to output at their
+    path relative to the common parent directory of all inputs.
+    """
+    papers, kept, digests, skipped, hits = 0, 0, 0, 0, Counter()
+    files, outputs = list(iter_digests(paths)), repeat(None)
+    if output is not None:
+        output.mkdir(parents=True, exist_ok=True)
+        base = commonpath([abspath(path) if Path(path).is_dir() else abspath(Path(path).parent) for path in paths])
+        outputs = [output / Path(abspath(file)).relative_to(base) for file in files]
+
+    matcher = keywords if isinstance(keywords, Matcher) else Matcher(keywords)
+    with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(matcher,)) as executor:
+        for result in executor.map(filter_digest, files, outputs, chunksize=8):
+            if result is None:
+                skipped += 1
+            else:
+                papers, kept, digests = papers + result[0], kept + result[1], digests + 1
+                hits.update(result[2])
+
+    for keyword, count in hits.most_common():
+        print(f"{count:8d}  {keyword}")
+    print(f"Kept {kept} of {papers} papers in {digests} digests ({skipped} other files skipped).")
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description="Filter the arXiv daily title/abstract distribution based on keywords of interest."
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--stream",
+        action="store_true",
+        help="Write papers as soon as they are read (the summary moves to the end).",
+    )
+    group.add_argument("--rank",
+        action="store_true",
+        help="Order papers by relevance and show their scores.",
+    )
+    group.add_argument("--batch",
+        nargs="+",
+        metavar="PATH",
+        help="Re-filter archived digests (files, directories or Maildirs) and report keyword hits.",
+    )
+    parser.add_argument("--keywords",
+        type=Path,
+        default=KEYWORDS,
+        metavar="FILE",
+        help="File with keywords of interest (default: %(default)s).",
+    )
+    parser.add_argument("--seen",
+        action="store_true",
+        help="Skip papers which were already delivered in another digest.",
+    )
+    parser.add_argument("--output",
+        type=Path,
+        metavar="DIR",
+        help="Write the digests filtered by --batch to this directory.",
+    )
+    parser.add_argument("--jobs",
+        type=int,
+        default=cpu_count(),
+        help="Number of worker processes for --batch (default: %(default)s).",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    print(ArxivMail(stdin.read()).filter(KEYWORDS))
+    args = parse_args()
+    try:
+        matcher = load_matcher(args.keywords)
+    except (OSError, ValueError) as e:
+        if args.batch:
+            exit(str(e))
+        # as a display filter, still show the digest
+        print(f"Not filtering: {e}", file=stderr)
+        stdout.writelines(stdin)
+        exit()
+
+    if args.batch:
+        batch(args.batch, matcher, args.output, args.jobs)
+    else:
+        with SeenCache() if args.seen else nullcontext() as seen:
+            if args.stream:
+                ArxivMail.stream(stdin, matcher, seen=seen)
+            else:
+                print(ArxivMail(stdin.read()).filter(matcher, rank=args.rank, seen=seen))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+###############################################################################
+#   Benchmark the aerc filters on synthetic data and check that their output  #
+#               is still equivalent to the original implementations.          #
+###############################################################################
+
+from argparse import ArgumentParser
+from os import environ
+from pathlib import Path
+from random import Random
+from re import escape, search
+from string import ascii_lowercase
+from subprocess import Popen
+from sys import executable, exit
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+
+from addressbook import AddressBook, IndexedAddressBook, add_addr, fold, iter_addrs, remove_addr, words
+from arxiv import ArxivMail, load_rules
+
+KEYWORDS = Path(__file__).resolve().parents[1] / "arxiv-keywords"
+ADDRESSBOOK = Path(__file__).resolve().with_name("addressbook.py")
+
+
+def make_vocab(rng, size=5000):
+    return ["".join(rng.choices(ascii_lowercase, k=rng.randint(3, 10))) for _ in range(size)]
+
+
+def make_addressbook(rows, seed=0):
+    """An address book with unique emails and names drawn from a small vocabulary."""
+    rng = Random(seed)
+    names, domains = make_vocab(rng, 2000), [f"{word}.org" for word in make_vocab(rng, 50)]
+    lines = []
+    for idx in range(rows):
+        first, last = rng.choice(names), rng.choice(names)
+        lines.append(f"{first}.{last}{idx}@{rng.choice(domains)}\t{first.title()} {last.title()}\n")
+    return "".join(lines)
+
+
+def make_digest(papers, keywords, seed=0):
+    """
+    An arXiv digest with new submissions, cross-lists and replacements, where
+    about every tenth paper mentions one of the keywords.
+    """
+    rng, sep = Random(seed), ArxivMail.sep
+    vocab = make_vocab(rng)
+    text = lambda n: " ".join(rng.choices(vocab, k=n))
+
+    entries = []
+    for idx in range(papers):
+        kind = rng.random()
+        if kind < 0.7:
+            head = f"arXiv:2406.{idx:05d}\nDate: Mon, 3 Jun 2024 17:59:59 GMT   (1234kb,D)\n"
+        elif kind < 0.85:
+            head = f"arXiv:2406.{idx:05d} (*cross-listing*)\nDate: Fri, 31 May 2024 (v1), last revised 3 Jun 2024 (this version, v2))\n"
+        else:
+            head = f"arXiv:2305.{idx:05d}\nreplaced with revised version Mon, 3 Jun 2024 12:00:00 GMT   (1234kb)\n"
+        abstract = [text(12) for _ in range(rng.randint(6, 16))]
+        if rng.random() < 0.1:
+            abstract[rng.randrange(len(abstract))] += " " + rng.choice(keywords)
+        entries.append(
+            f"\\\\\n{head}\nTitle: {text(8)}\n  {text(4)}\nAuthors: {text(6)}\nCategories: cs.CV cs.CL\n"
+            f"Comments: {text(5)}\n\\\\\n" + "\n".join(f"  {line}" for line in abstract)
+            + f"\n\\\\ ( https://arxiv.org/abs/2406.{idx:05d} ,  1234kb)\n"
+        )
+
+    header = f"Subject: cs daily Title/Abstract Digest {seed}\n{sep}{sep}Send any comments\n{sep} Submissions to:\n"
+    return f"{header}{sep}{sep}{sep.join(entries)}{sep}{ArxivMail.footer}\n"
+
+
+def reference_match(content, pattern, prefix=False):
+    if prefix: # the index matches patterns shorter than a trigram only at word starts
+        return [line for line in content.splitlines() if f" {pattern.casefold()}" in words(line)]
+    return [line for line in content.splitlines() if pattern.lower() in line.lower()]
+
+
+def match_addr(addr, content):
+    """Whether content has a row for an email, i.e., whether an address book contains it."""
+    return search(rf"(?m)^{escape(addr)}\t", content) is not None
+
+
+def reference_remove(content, email):
+    return "".join(line for line in content.splitlines(True) if not match_addr(email, line))
+
+
+def reference_filter(mail, keywords):
+    """The original filter of arxiv.py, which tests every keyword separately."""
+    sep, header_sep, footer = ArxivMail.sep, ArxivMail.header_sep, ArxivMail.footer
+    header, _, papers = mail.rpartition(header_sep)
+    papers = papers.rstrip(footer).split(sep)
+    kept = [paper for paper in papers if any(key.lower() in " ".join(paper.split()).lower() for key in keywords)]
+    header = sep.join([header, f"Filtered {len(papers) - len(kept)} papers.\n"])
+    return "".join([header, header_sep, sep.join(kept), footer])
+
+
+class Benchmark:
+    def __init__(self, repeat=5):
+        self.repeat, self.failures = repeat, 0
+
+    def time(self, name, size, func):
+        """Report the best wall time of several runs and the peak memory of a separate, traced run."""
+        best = float("inf")
+        for _ in range(self.repeat):
+            begin = perf_counter()
+            func()
+            best = min(best, perf_counter() - begin)
+        start()
+        func()
+        peak = get_traced_memory()[1]
+        stop()
+        print(f"{name:<32}{size:>9}{1000 * best:>12.3f} ms{peak / 1024:>12.0f} KiB")
+
+    def check(self, name, size, result, expected):
+        if result != expected:
+            self.failures += 1
+            print(f"{name:<32}{size:>9}  output differs from the original implementation!")
+
+    def addressbook(self, rows):
+        content = make_addressbook(rows)
+        emails = [line.split("\t")[0] for line in content.splitlines()]
+        new = (f"Bench Mark <bench{idx}@example.org>" for idx in range(10**9))
+        rng = Random(rows)
+
+        for kind in (AddressBook, IndexedAddressBook):
+            with TemporaryDirectory() as tmp:
+                path = Path(tmp) / "addressbook.tsv"
+                path.write_text(content)
+                open_book = lambda: kind(path) if kind is AddressBook else kind(path, Path(tmp) / "index.db")
+                if kind is IndexedAddressBook:
+                    rebuild = lambda: [*map(Path.unlink, Path(tmp).glob("index.db*")), open_book()]
+                    self.time(f"{kind.__name__}() (rebuild)", rows, rebuild)
+                self.time(f"{kind.__name__}()", rows, open_book)
+                book = open_book()
+
+                for pattern in ("a", emails[rows // 2].split("@")[1][:3], emails[rows // 3]):
+                    self.time(f"iter_addrs({pattern[:12]!r})", rows, lambda: list(iter_addrs(pattern, 50, book)))
+                    expected = reference_match(content, pattern, kind is IndexedAddressBook and len(pattern) < 3)
+                    self.check(f"iter_addrs({pattern[:12]!r})", rows, sorted(iter_addrs(pattern, None, book)), sorted(expected))
+
+                self.time("add_addr()", rows, lambda: add_addr(next(new), book=book))
+                self.time("remove_addr()", rows, lambda: remove_addr(emails.pop(rng.randrange(len(emails))), book=book))
+
+                # compare a fresh address book after a fixed sequence of modifications
+                path, book = Path(tmp) / "check.tsv", None
+                path.write_text(content)
+                book = open_book()
+                add_addr("Bench Mark <bench@example.org>", book=book)
+                remove_addr(emails[0], book=book)
+                expected = reference_remove(content + "bench@example.org\tBench Mark\n", emails[0])
+                self.check("add_addr() + remove_addr()", rows, fold(path.read_text())[0], expected)
+
+    def stress(self, procs):
+        """
+        Run add and remove processes in parallel on one address book, every
+        second one with the index, and check that no row was duplicated or lost.
+        Each removed address is removed once, each new one added twice.
+        """
+        rng = Random(procs)
+        with TemporaryDirectory() as tmp:
+            path = Path(tmp) / ".config/aerc/addressbook.tsv"
+            path.parent.mkdir(parents=True)
+            initial = [f"stress{idx}@example.org" for idx in range(procs)]
+            path.write_text("".join(f"{email}\tStress {idx}\n" for idx, email in enumerate(initial)))
+            removed, added = rng.sample(initial, procs // 2), [f"new{idx}@example.org" for idx in range(procs // 4)]
+            commands = [["--remove", email] for email in removed] + [["--add", f"New <{email}>"] for email in added * 2]
+            rng.shuffle(commands)
+
+            begin, env = perf_counter(), dict(environ, XDG_CONFIG_HOME=tmp, XDG_CACHE_HOME=tmp)
+            processes = [
+                Popen([executable, ADDRESSBOOK, *(["--index"] if idx % 2 else []), *command], env=env)
+                for idx, command in enumerate(commands)
+            ]
+            failed = sum(process.wait() != 0 for process in processes)
+            print(f"{'stress (add/remove processes)':<32}{len(commands):>9}{1000 * (perf_counter() - begin):>12.3f} ms")
+
+            expected = sorted(set(initial).difference(removed).union(added))
+            rows = [line.partition("\t")[0] for line in fold(path.read_text())[0].splitlines()]
+            index = IndexedAddressBook(path, Path(tmp) / "aerc/addressbook.db")
+            self.check("stress (exit status)", len(commands), failed, 0)
+            self.check("stress (rows)", len(commands), sorted(rows), expected)
+            self.check("stress (index)", len(commands), sorted(index.emails()), expected)
+
+    def arxiv(self, papers):
+        keywords = [rule.keyword for rule in load_rules(KEYWORDS)]
+        text = make_digest(papers, keywords)
+        mail = ArxivMail(text)
+        filtered = mail.filter(keywords)
+
+        self.time("ArxivMail()", papers, lambda: ArxivMail(text))
+        self.time("ArxivMail.filter()", papers, lambda: ArxivMail(text).filter(keywords))
+        self.time("ArxivMail.__repr__()", papers, lambda: repr(filtered))
+        self.check("ArxivMail.filter()", papers, repr(mail.filter(keywords)), reference_filter(text, keywords))
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description="Benchmark the aerc filters and check their output against the original implementations."
+    )
+    parser.add_argument("--only",
+        choices=["addressbook", "stress", "arxiv"],
+        help="Only benchmark one of the filters.",
+    )
+    parser.add_argument("--rows",
+        nargs="+",
+        type=int,
+        default=[1000, 10_000, 100_000],
+        help="Address book sizes (default: %(default)s).",
+    )
+    parser.add_argument("--procs",
+        nargs="+",
+        type=int,
+        default=[200],
+        help="Numbers of parallel processes for the stress test (default: %(default)s).",
+    )
+    parser.add_argument("--papers",
+        nargs="+",
+        type=int,
+        default=[10, 100, 1000, 5000],
+        help="Digest sizes (default: %(default)s).",
+    )
+    parser.add_argument("--repeat",
+        type=int,
+        default=5,
+        help="Number of timed runs of which the best is reported (default: %(default)s).",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    benchmark = Benchmark(args.repeat)
+
+    if args.only in (None, "addressbook"):
+        for rows in args.rows:
+            benchmark.addressbook(rows)
+    if args.only in (None, "stress"):
+        for procs in args.procs:
+            benchmark.stress(procs)
+    if args.only in (None, "arxiv"):
+        for papers in args.papers:
+            benchmark.arxiv(papers)
+
+    exit(benchmark.failures > 0)
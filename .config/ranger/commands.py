@@ -1,99 +1,690 @@
-from subprocess import PIPE
-from shlex import quote
+from subprocess import DEVNULL, PIPE, Popen, run
+import ranger
 from ranger.api.commands import Command
-from ranger.core.loader import CommandLoader
-from os.path import isdir, abspath, basename
+from ranger.core.loader import Loadable
+from ranger.container.directory import (Directory, sort_by_basename, sort_by_basename_icase, sort_naturally,
+                                        sort_naturally_icase)
+from ranger.container.file import File
+from os.path import isdir, abspath, basename, dirname, join, commonpath, realpath, getsize, lexists, expanduser
+from os import (scandir, stat, pipe, close, makedirs, replace, cpu_count, read, listdir, rename, chmod, utime,
+                symlink, fsdecode)
+from stat import S_ISLNK
+from hashlib import sha1
+from pickle import dump, load
+from tempfile import NamedTemporaryFile, mkdtemp
+from shutil import rmtree
+from fnmatch import fnmatch
+from zipfile import ZipFile, is_zipfile
+from tarfile import FilterError, data_filter, is_tarfile, open as taropen
+from contextlib import closing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from queue import Queue
+from threading import Event, Lock, Thread
+from re import compile, escape, sub
+from select import select
+from signal import SIGCONT, SIGSTOP
+from time import mktime, time
+
+# maximum number of entries in a flattened view
+FLAT_LIMIT = 100000
+# maximum number of archives which are extracted at the same time, since more
+# parallel writers than this mostly make the disk seek
+EXTRACT_JOBS = 4
+# size of the chunks in which archive members are extracted
+EXTRACT_CHUNK = 1 << 20
+# pseudo filesystems which are never worth scanning
+PSEUDO_FILESYSTEMS = {"proc", "sysfs", "devtmpfs", "devpts", "cgroup", "cgroup2", "debugfs", "tracefs"}
+
+def gitignore_rule(base, pattern):
+    """
+    Translate a line of a .gitignore file in directory base (relative to the
+    scanned root) into a (base, regex, negate, dir_only) rule.
+    """
+    negate, pattern = pattern.startswith("!"), pattern.removeprefix("!")
+    dir_only, pattern = pattern.endswith("/"), pattern.rstrip("/")
+    # patterns without a slash match at any depth, others relative to base
+    regex, idx = "" if "/" in pattern else "(?:.*/)?", 0
+    pattern = pattern.removeprefix("/")
+    while idx < len(pattern):
+        if pattern.startswith("**/", idx):
+            regex, idx = regex + "(?:.*/)?", idx + 3
+        elif pattern.startswith("/**", idx) and idx + 3 == len(pattern):
+            regex, idx = regex + "/.*", idx + 3
+        elif pattern[idx] == "*":
+            regex, idx = regex + "[^/]*", idx + 1
+        elif pattern[idx] == "?":
+            regex, idx = regex + "[^/]", idx + 1
+        elif pattern[idx] == "[" and (end := pattern.find("]", idx + 2)) > 0:
+            chars = pattern[idx + 1:end].replace("\\", "\\\\")
+            regex, idx = regex + "[" + ("^" + chars[1:] if chars[0] == "!" else chars) + "]", end + 1
+        elif pattern[idx] == "\\" and idx + 1 < len(pattern):
+            regex, idx = regex + escape(pattern[idx + 1]), idx + 2
+        else:
+            regex, idx = regex + escape(pattern[idx]), idx + 1
+    return base, compile(regex), negate, dir_only
+
+def read_gitignore(path, base):
+    try:
+        with open(join(path, ".gitignore")) as f:
+            lines = [line.rstrip("\n").rstrip() for line in f]
+    except (OSError, UnicodeDecodeError):
+        return ()
+    return tuple(gitignore_rule(base, line) for line in lines if line and not line.startswith("#"))
+
+def is_ignored(rules, rel, is_dir):
+    """Whether the path rel is ignored, where the last matching rule wins."""
+    ignored = False
+    for base, regex, negate, dir_only in rules:
+        if (is_dir or not dir_only) and regex.fullmatch(rel[len(base):]):
+            ignored = not negate
+    return ignored
+
+def pseudo_mounts():
+    try:
+        with open("/proc/self/mounts") as f:
+            return {mount for _, mount, fstype, *_ in map(str.split, f) if fstype in PSEUDO_FILESYSTEMS}
+    except OSError:
+        return set()
+
+class Scanner:
+    """
+    Walk a directory tree with a thread pool where each directory is scanned
+    by its own task, and put the relative paths found in each directory into
+    a queue as soon as they are known (followed by None when the walk is
+    complete). Hidden and gitignored entries as well as pseudo filesystems are
+    pruned, symlinks are followed unless they lead into a loop.
+
+    Directory listings are kept in an index which maps relative directories to
+    their mtime, the mtime of their .gitignore, their entries and their
+    gitignore rules. Directories whose mtimes did not change since the index
+    was saved are served from it, so only changed directories are read again.
+    """
+
+    def __init__(self, root, dirs_only=False, max_depth=None, workers=8, index=None):
+        self.dirs_only, self.max_depth = dirs_only, max_depth
+        self.paths, self.cancelled, self.lock = Queue(), Event(), Lock()
+        self.pending, self.visited, self.pseudo = 0, set(), pseudo_mounts()
+        self.index, self.scanned, self.complete = index or {}, {}, False
+        self.pool = ThreadPoolExecutor(workers)
+        self.submit(root, "", (), 0)
+
+    def visit(self, path, info):
+        """Remember a directory and return whether it was not visited before."""
+        with self.lock:
+            if (key := (info.st_dev, info.st_ino)) in self.visited or path in self.pseudo:
+                return False
+            self.visited.add(key)
+            return True
+
+    def submit(self, path, rel, rules, depth):
+        with self.lock:
+            self.pending += 1
+        self.pool.submit(self.scan, path, rel, rules, depth)
+
+    def listing(self, path, rel, mtime):
+        """Entries and gitignore rules of a directory, from the index if they did not change."""
+        cached = self.index.get(rel)
+        if cached and cached[0] == mtime and (cached[1] is None or mtime_ns(join(path, ".gitignore")) == cached[1]):
+            self.scanned[rel] = cached
+        else:
+            with scandir(path) as entries:
+                entries = [(entry.name, entry.is_dir()) for entry in entries if not entry.name.startswith(".")]
+            self.scanned[rel] = mtime, mtime_ns(join(path, ".gitignore")), entries, read_gitignore(path, rel)
+        return self.scanned[rel][2:]
+
+    def scan(self, path, rel, rules, depth):
+        try:
+            if self.cancelled.is_set() or not self.visit(path, info := stat(path)):
+                return
+            found, subdirs = [], []
+            entries, ignore = self.listing(path, rel, info.st_mtime_ns)
+            rules += ignore
+            for name, is_dir in entries:
+                child = rel + name
+                if is_ignored(rules, child, is_dir):
+                    continue
+                if is_dir:
+                    found.append(child)
+                    if self.max_depth is None or depth < self.max_depth:
+                        subdirs.append((join(path, name), child + "/"))
+                elif not self.dirs_only:
+                    found.append(child)
+            if found:
+                self.paths.put(found)
+            for subdir, subrel in subdirs:
+                self.submit(subdir, subrel, rules, depth + 1)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.pending -= 1
+                done = self.pending == 0
+            if done:
+                self.complete = not self.cancelled.is_set() and self.max_depth is None
+                self.paths.put(None)
+
+    def feed(self, out):
+        """Write paths to a file (e.g., the stdin of fzf) until the walk is complete or cancelled."""
+        try:
+            with out:
+                while (found := self.paths.get()) is not None and not self.cancelled.is_set():
+                    out.write("".join(f"{path}\n" for path in found))
+                    out.flush()
+        except OSError: # fzf exited
+            pass
+        finally:
+            self.cancel()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.paths.put(None)
+
+    def save(self, path):
+        """
+        Atomically write the index once running scans are done. Directories
+        which no longer exist are only dropped after a complete walk.
+        """
+        self.pool.shutdown(wait=True)
+        index = self.scanned if self.complete else {**self.index, **self.scanned}
+        makedirs(dirname(path), exist_ok=True)
+        with NamedTemporaryFile("wb", dir=dirname(path), delete=False) as f:
+            dump(index, f)
+        replace(f.name, path)
+
+def mtime_ns(path):
+    try:
+        return stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def index_path(root):
+    return join(ranger.args.cachedir, "fzf_select", sha1(root.encode()).hexdigest())
+
+def load_index(root):
+    try:
+        with open(index_path(root), "rb") as f:
+            return load(f)
+    except Exception: # missing or corrupt index
+        return {}
+
+def holders(path, limit=5):
+    """Describe the processes which use the filesystem mounted at path (empty if unknown)."""
+    try:
+        pids = run(["fuser", "-m", path], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, text=True).stdout.split()
+    except OSError: # e.g., psmisc is not installed
+        return ""
+    names = []
+    for pid in pids[:limit]:
+        try:
+            with open(f"/proc/{pid}/comm") as comm:
+                names.append(f"{comm.read().strip()} ({pid})")
+        except OSError:
+            names.append(pid)
+    return ", ".join(names) + (f" and {len(pids) - limit} more" if len(pids) > limit else "")
+
+def unmount(path):
+    """Sync and unmount the filesystem mounted at path, and return an error message if that failed."""
+    try:
+        run(["sync", "-f", path], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        result = run(["umount", path], stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE, text=True)
+    except OSError as error:
+        return f"Unmounting {path} failed: {error}"
+    if result.returncode != 0:
+        if "busy" in result.stderr and (used_by := holders(path)):
+            return f"{path} is busy, used by {used_by}"
+        return result.stderr.strip() or f"Unmounting {path} failed."
+
+class UmountLoader(Loadable):
+    """
+    Sync and unmount several filesystems concurrently, report the ones which
+    couldn't be unmounted, and refresh the view as each one is done.
+    """
+
+    def __init__(self, fm, paths):
+        self.fm, self.paths = fm, paths
+        Loadable.__init__(self, self.generate(), "unmounting: " + ", ".join(paths))
+
+    def generate(self):
+        with ThreadPoolExecutor(len(self.paths)) as pool:
+            running = {pool.submit(unmount, path): path for path in self.paths}
+            while running:
+                for future in wait(list(running), 0.03, FIRST_COMPLETED)[0]:
+                    path = running.pop(future)
+                    if error := future.result():
+                        self.fm.notify(error, bad=True)
+                    self.fm.get_directory(dirname(path)).load_content()
+                self.percent = 100 * (len(self.paths) - len(running)) / len(self.paths)
+                self.description = "unmounting: " + ", ".join(running.values())
+                yield
 
 class umount(Command):
     """
-    :umount [device_mount_point]
+    :umount [device_mount_point]...
 
-    unmount removable devices
+    unmount removable devices (the given ones or the selection), several at once
     """
 
     def execute(self):
-        cmd = "umount "
-        if self.arg(1):
-            self.fm.run(cmd + quote(self.arg(1)))
+        paths = [abspath(expanduser(path)) for path in self.args[1:]] or \
+            [f.path for f in self.fm.thistab.get_selection()]
+        if not paths:
+            self.fm.notify("Nothing to unmount.", bad=True)
+            return
+        self.fm.loader.add(UmountLoader(self.fm, paths))
+
+def sort_key(directory):
+    """The function whose (cached) result ranger sorts a directory by."""
+    key = directory.sort_dict.get(directory.settings.sort, sort_by_basename)
+    if directory.settings.sort_case_insensitive:
+        key = {sort_by_basename: sort_by_basename_icase, sort_naturally: sort_naturally_icase}.get(key, key)
+    return key
+
+class FlatLoader(Loadable):
+    """
+    Load the flattened view of a directory in the background. The tree is
+    walked with scandir one directory at a time, and entries are added to the
+    view in sorted batches, up to a maximum depth and number of entries.
+    Since the whole view has to be sorted again for each batch, batches are
+    added less often the longer this takes. Removing the loader from the task
+    view cancels it.
+    """
+    batch = 500
+
+    def __init__(self, fm, directory, depth=-1, limit=FLAT_LIMIT):
+        self.fm, self.directory, self.depth, self.limit = fm, directory, depth, limit
+        self.cancelled, self.pending = False, []
+        Loadable.__init__(self, self.generate(), "flattening: " + directory.path)
+
+    def generate(self):
+        directory, root = self.directory, self.directory.path
+        directory._clear_marked_items()
+        directory.files_all, directory.filenames, directory.content_loaded = [], [], True
+        stack, batch, visited, count = [(root, 0)], self.pending, set(), 0
+        due, key = 0, sort_key(directory)
+
+        while stack and not self.cancelled:
+            path, depth = stack.pop()
+            try:
+                with scandir(path) as entries:
+                    entries = list(entries)
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    lstat = entry.stat(follow_symlinks=False)
+                    stats = (entry.stat() if entry.is_symlink() else lstat), lstat
+                except OSError:
+                    stats = None
+                if stats and entry.is_dir():
+                    item = Directory(entry.path, preload=stats, path_is_abs=True, basename_is_rel_to=root)
+                    # like ranger, only follow symlinks when the depth is limited
+                    if (self.depth == -1 and not entry.is_symlink() or 0 <= depth < self.depth) \
+                            and (stats[0].st_dev, stats[0].st_ino) not in visited:
+                        visited.add((stats[0].st_dev, stats[0].st_ino))
+                        stack.append((entry.path, depth + 1))
+                else:
+                    item = File(entry.path, preload=stats, path_is_abs=True, basename_is_rel_to=root)
+                item.load()
+                key(item) # compute sort keys here, which is slow for natural sorting
+                batch.append(item)
+                if (count := count + 1) >= self.limit:
+                    self.fm.notify(f"Flattened view is limited to {self.limit} entries.", bad=True)
+                    stack = []
+                    break
+                if len(batch) % self.batch == 0:
+                    # spend at most a fifth of the time on sorting the view
+                    if time() >= due:
+                        start = time()
+                        self.add()
+                        due = 5 * time() - 4 * start
+                    yield
+            yield
+        self.add()
+
+    def add(self):
+        """Show the pending entries in the view."""
+        directory, items = self.directory, self.pending
+        directory.files_all += items
+        directory.filenames += [item.path for item in items]
+        del items[:]
+        directory.sort()
+        directory.cycle_list = None
+        if directory.pointed_obj is not None:
+            directory.sync_index()
         else:
-            self.fm.run(cmd + quote(self.fm.thisfile.path))
+            directory.move(to=0)
+        directory.correct_pointer()
+        directory.last_update_time = time()
+        self.description = f"flattening: {directory.path} ({len(directory.files_all)} entries)"
+
+    def destroy(self):
+        # keep what has been loaded so far
+        if not self.cancelled and self.pending:
+            self.add()
+        self.cancelled = True
+
+def flatten(fm, directory, depth=-1, limit=FLAT_LIMIT):
+    """
+    Show a flattened view of a directory which is loaded by a FlatLoader.
+    While the view is shown, ranger's own (synchronous) loading of the
+    directory is replaced by restarting the loader.
+    """
+    if loader := getattr(directory, "flat_loader", None):
+        fm.loader.remove(loader)
+        loader.destroy()
+    directory.unload()
+    directory.flat = depth
+    directory.flat_loader = FlatLoader(fm, directory, depth, limit)
+    directory.load_content = lambda *_, **__: flatten(fm, directory, depth, limit)
+    directory.load_content_if_outdated = lambda *_, **__: False
+    fm.loader.add(directory.flat_loader)
+
+def unflatten(fm, directory):
+    loader = directory.__dict__.pop("flat_loader")
+    fm.loader.remove(loader)
+    loader.destroy()
+    del directory.load_content, directory.load_content_if_outdated
+    directory.unload()
+    directory.flat = 0
+    directory.load_content()
 
 class toggle_flat(Command):
     """
-    :toggle_flat
+    :toggle_flat [depth] [max_entries]
 
     Flattens or unflattens the directory view.
+
+    The flattened view is loaded in the background and can be cancelled in
+    the task view. By default, it is not limited in depth but to 100000
+    entries.
     """
 
     def execute(self):
-        if self.fm.thisdir.flat == 0:
-            self.fm.thisdir.unload()
-            self.fm.thisdir.flat = -1
-            self.fm.thisdir.load_content()
+        if hasattr(self.fm.thisdir, "flat_loader"):
+            unflatten(self.fm, self.fm.thisdir)
         else:
-            self.fm.thisdir.unload()
-            self.fm.thisdir.flat = 0
-            self.fm.thisdir.load_content()
+            depth = int(self.arg(1)) if self.arg(1).lstrip("-").isdigit() else -1
+            limit = int(self.arg(2)) if self.arg(2).isdigit() else FLAT_LIMIT
+            flatten(self.fm, self.fm.thisdir, depth, limit)
 
 class fzf_select(Command):
     """
-    :fzf_select
+    :fzf_select [max_depth]
 
     Find a file using fzf.
 
-    With a prefix argument select only directories.
+    With a prefix argument select only directories. Paths are streamed into
+    fzf while the tree is scanned, skipping hidden and gitignored files. An
+    index of the tree is cached, so that only changed directories are read
+    again on subsequent calls.
 
     See: https://github.com/junegunn/fzf
     """
     def execute(self):
-        if self.quantifier:
-            # match only directories
-            command=r"find -L . \( -path '*/\.*' -o -fstype 'dev' -o -fstype 'proc' \) -prune \
-            -o -type d -print 2> /dev/null | sed 1d | cut -b3- | fzf +m"
-        else:
-            # match files and directories
-            command=r"find -L . \( -path '*/\.*' -o -fstype 'dev' -o -fstype 'proc' \) -prune \
-            -o -print 2> /dev/null | sed 1d | cut -b3- | fzf +m"
-        fzf = self.fm.execute_command(command, universal_newlines=True, stdout=PIPE)
+        root = self.fm.thisdir.path
+        max_depth = int(self.arg(1)) if self.arg(1).isdigit() else None
+        scanner = Scanner(root, dirs_only=bool(self.quantifier), max_depth=max_depth, index=load_index(root))
+        read, write = pipe()
+        # paths are passed through as bytes, so that names which aren't valid UTF-8 survive
+        Thread(target=scanner.feed, args=(open(write, "w", errors="surrogateescape"),), daemon=True).start()
+        try:
+            fzf = self.fm.execute_command(["fzf", "+m"], stdin=read, stdout=PIPE)
+        finally:
+            close(read)
+            scanner.cancel()
+            Thread(target=scanner.save, args=(index_path(root),), daemon=True).start()
+        if fzf is None:
+            return
         stdout, _ = fzf.communicate()
         if fzf.returncode == 0:
-            fzf_file = abspath(stdout.rstrip('\n'))
+            fzf_file = abspath(join(root, fsdecode(stdout.rstrip(b'\n'))))
             if isdir(fzf_file):
                 self.fm.cd(fzf_file)
             else:
                 self.fm.select_file(fzf_file)
 
 
+def inside(root, path):
+    """Whether path (with symlinks resolved) is inside of directory root."""
+    return commonpath([root, realpath(path)]) == root
+
+def selected(name, patterns):
+    """Whether an archive member is selected by any of the glob patterns (or there are none)."""
+    return not patterns or any(fnmatch(name, pattern) or fnmatch(name, pattern.rstrip("/") + "/*")
+        for pattern in patterns)
+
+def is_archive(path):
+    """Whether an archive can be extracted with unpack() instead of aunpack."""
+    try:
+        return is_zipfile(path) or is_tarfile(path)
+    except OSError:
+        return False
+
+def unzip(archive, dest, patterns):
+    root = realpath(dest)
+    with ZipFile(archive) as zipf:
+        # members which would end up outside of dest are skipped
+        members = [(info, join(dest, info.filename)) for info in zipf.infolist()
+            if selected(info.filename.rstrip("/"), patterns) and inside(root, join(dest, info.filename))]
+        total, done = sum(info.file_size for info, _ in members) or 1, 0
+        for info, path in members:
+            # check again, symlinks extracted before could redirect the path
+            if not inside(root, path):
+                continue
+            if info.is_dir():
+                makedirs(path, exist_ok=True)
+                continue
+            makedirs(dirname(path), exist_ok=True)
+            mode = info.external_attr >> 16
+            with zipf.open(info) as src:
+                if S_ISLNK(mode):
+                    # like tarfile's data filter, skip symlinks which point outside of dest
+                    if inside(root, join(dirname(path), target := src.read().decode())):
+                        symlink(target, path)
+                    continue
+                with open(path, "wb") as dst:
+                    while chunk := src.read(EXTRACT_CHUNK):
+                        dst.write(chunk)
+                        done += len(chunk)
+                        yield done / total
+            # like tarfile's data filter, drop setuid, setgid, sticky and group/other write bits
+            if mode & 0o7777:
+                chmod(path, mode & 0o755)
+            mtime = mktime(info.date_time + (0, 0, -1))
+            utime(path, (mtime, mtime))
+
+def untar(archive, dest, patterns):
+    size, directories = getsize(archive) or 1, []
+    # read the archive as a stream, so that compressed archives are only decompressed once
+    with open(archive, "rb") as raw, taropen(fileobj=raw, mode="r|*") as tar:
+        for member in tar:
+            if not selected(member.name.rstrip("/"), patterns):
+                continue
+            try:
+                # members which would end up outside of dest or are special files are skipped
+                member = data_filter(member, dest)
+            except FilterError:
+                continue
+            if member.isfile():
+                path = join(dest, member.name)
+                makedirs(dirname(path), exist_ok=True)
+                with tar.extractfile(member) as src, open(path, "wb") as dst:
+                    while chunk := src.read(EXTRACT_CHUNK):
+                        dst.write(chunk)
+                        yield raw.tell() / size
+                if member.mode is not None:
+                    chmod(path, member.mode)
+                if member.mtime is not None:
+                    utime(path, (member.mtime, member.mtime))
+            else:
+                # like extractall, set attributes of directories once their contents are written
+                tar.extract(member, dest, set_attrs=not member.isdir(), filter="fully_trusted")
+                if member.isdir():
+                    directories.append(member)
+            yield raw.tell() / size
+    for member in sorted(directories, key=lambda member: member.name, reverse=True):
+        path = join(dest, member.name)
+        if member.mode is not None:
+            chmod(path, member.mode)
+        if member.mtime is not None:
+            utime(path, (member.mtime, member.mtime))
+
+def unpack(archive, dest, patterns=()):
+    """
+    Extract the members of a zip or tar archive which match any of the glob
+    patterns (all if there are none) like aunpack does: directly into dest if
+    the archive contains a single file or directory which doesn't exist yet,
+    and into a new directory named after the archive otherwise. Files are
+    copied in large chunks, after each of which the fraction done is yielded.
+    """
+    tmp = mkdtemp(prefix=".extract-", dir=dest)
+    try:
+        yield from (unzip if is_zipfile(archive) else untar)(archive, tmp, patterns)
+        if not (entries := listdir(tmp)):
+            raise ValueError("no matching members")
+        if len(entries) == 1 and not lexists(join(dest, entries[0])):
+            rename(join(tmp, entries[0]), join(dest, entries[0]))
+        else:
+            name = basename(archive).removesuffix(".zip")
+            name = sub(r"\.(tar(\.\w+)?|t[gbx]z|tbz2|tzst)$", "", name)
+            target, idx = join(dest, name), 0
+            while lexists(target):
+                idx += 1
+                target = join(dest, f"{name}-{idx}")
+            rename(tmp, target)
+    finally:
+        rmtree(tmp, ignore_errors=True)
+
+class ExtractLoader(Loadable):
+    """
+    Extract several archives concurrently, using up to jobs threads or aunpack
+    processes. Zip and tar archives are extracted in-process with unpack(),
+    which reports the progress of each archive and supports selecting members
+    with glob patterns; other formats are handed to aunpack (with flags). The
+    destination is refreshed whenever an archive is done and errors are
+    reported per archive, without affecting the others.
+    """
+    progressbar_supported = True
+
+    def __init__(self, fm, archives, dest, patterns=(), flags=(), jobs=min(cpu_count() or 1, EXTRACT_JOBS)):
+        self.fm, self.archives, self.dest, self.jobs = fm, archives, dest, jobs
+        self.patterns, self.flags = list(patterns), list(flags)
+        self.processes, self.threads, self.progress = {}, {}, {}
+        self.pool, self.resumed, self.cancelled = ThreadPoolExecutor(jobs), Event(), False
+        self.resumed.set()
+        Loadable.__init__(self, self.generate(), "extracting: " + ", ".join(basename(path) for path in archives))
+
+    def extract(self, archive):
+        """Extract an archive in a worker thread, which blocks while the loader is paused."""
+        with closing(unpack(archive, self.dest, self.patterns)) as chunks:
+            for self.progress[archive] in chunks:
+                self.resumed.wait()
+                if self.cancelled:
+                    break
+
+    def start(self, archive):
+        if is_archive(archive):
+            self.progress[archive] = 0
+            self.threads[self.pool.submit(self.extract, archive)] = archive
+        elif self.patterns:
+            self.fm.notify(f"Extracting {basename(archive)} failed: aunpack can't select members.", bad=True)
+        else:
+            try:
+                process = Popen(["aunpack", "-X", self.dest, *self.flags, "-e", archive], stdin=DEVNULL,
+                    stdout=DEVNULL, stderr=PIPE)
+            except OSError as error:
+                self.fm.notify(f"Extracting {basename(archive)} failed: {error}", bad=True)
+            else:
+                self.processes[process.stderr.fileno()] = process, archive, []
+
+    def finish_process(self, fd):
+        process, archive, errors = self.processes.pop(fd)
+        process.stderr.close()
+        if process.wait() != 0:
+            error = b"".join(errors).decode(errors="replace").strip().splitlines()
+            self.fm.notify(f"Extracting {basename(archive)} failed" + (f": {error[-1]}" if error else "."), bad=True)
+        self.fm.get_directory(self.dest).load_content()
+
+    def finish_thread(self, future):
+        archive = self.threads.pop(future)
+        del self.progress[archive]
+        if error := future.exception():
+            self.fm.notify(f"Extracting {basename(archive)} failed: {error}", bad=True)
+        self.fm.get_directory(self.dest).load_content()
+
+    def generate(self):
+        pending, total = list(reversed(self.archives)), len(self.archives)
+        while pending or self.processes or self.threads:
+            while pending and len(self.processes) + len(self.threads) < self.jobs:
+                self.start(pending.pop())
+            if self.processes:
+                # a process has finished when its stderr is closed
+                for fd in select(list(self.processes), [], [], 0.03)[0]:
+                    if chunk := read(fd, 4096):
+                        self.processes[fd][2].append(chunk)
+                    else:
+                        self.finish_process(fd)
+            for future in wait(list(self.threads), 0 if self.processes else 0.03, FIRST_COMPLETED)[0]:
+                self.finish_thread(future)
+            running = len(self.processes) + len(self.threads)
+            self.percent = 100 * (total - len(pending) - running + sum(self.progress.values())) / total
+            self.description = f"extracting ({total - len(pending) - running}/{total}): " + ", ".join(
+                [f"{basename(archive)} ({100 * self.progress[archive]:.0f}%)" for archive in self.threads.values()]
+                + [basename(archive) for _, archive, _ in self.processes.values()])
+            yield
+        self.pool.shutdown()
+
+    def signal(self, signal):
+        for process, *_ in self.processes.values():
+            try:
+                process.send_signal(signal)
+            except OSError:
+                pass
+
+    def pause(self):
+        if not self.paused:
+            self.signal(SIGSTOP)
+            self.resumed.clear()
+            Loadable.pause(self)
+
+    def unpause(self):
+        if self.paused:
+            self.signal(SIGCONT)
+            self.resumed.set()
+            Loadable.unpause(self)
+
+    def destroy(self):
+        self.cancelled = True
+        self.resumed.set()
+        for process, *_ in self.processes.values():
+            process.kill()
+            process.wait()
+        self.pool.shutdown(cancel_futures=True)
+
 class extracthere(Command):
     def execute(self):
         """
-        :extracthere
+        :extracthere [-m pattern]... [aunpack_flags]
 
-        Extract copied files to current directory
+        Extract copied files to current directory, several archives at once.
+        Only the members of zip and tar archives which match the glob patterns
+        given with -m are extracted. Archives in other formats are extracted
+        with aunpack, which is also passed the remaining flags.
         """
         copied_files = tuple(self.fm.copy_buffer)
 
         if not copied_files:
             return
 
-        def refresh(_):
-            cwd = self.fm.get_directory(original_path)
-            cwd.load_content()
-
-        one_file = copied_files[0]
-        cwd = self.fm.thisdir
-        original_path = cwd.path
-        au_flags = ['-X', cwd.path]
-        au_flags += self.line.split()[1:]
-        au_flags += ['-e']
+        patterns, flags, args = [], [], iter(self.args[1:])
+        for arg in args:
+            if arg == "-m":
+                patterns.append(next(args, "*"))
+            else:
+                flags.append(arg)
 
         self.fm.copy_buffer.clear()
         self.fm.cut_buffer = False
-        if len(copied_files) == 1:
-            descr = "extracting: " + basename(one_file.path)
-        else:
-            descr = "extracting files from: " + basename(one_file.dirname)
-        obj = CommandLoader(args=['aunpack'] + au_flags + [f.path for f in copied_files], descr=descr)
-
-        obj.signal_bind('after', refresh)
-        self.fm.loader.add(obj)
+        self.fm.loader.add(ExtractLoader(self.fm, [f.path for f in copied_files], self.fm.thisdir.path,
+            patterns, flags))
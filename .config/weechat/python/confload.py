@@ -2,15 +2,23 @@
 """
 Confload: Create dotfiles-managable weechat configs with password manager integration.
 
-    * reads config file containing weechat commands with m4 macro processor
+    * reads config file containing weechat commands with a subset of the m4 macro
+      language (quotes, comments, dnl, define, undefine, ifdef and ifelse)
     * config file is expected to be in $WEECHAT_HOME/weechatrc
     * provides special m4 macro KEEPASS(<title>, <attr>) to read KeePassXC database
     * specify KeePassXC files with KEEPASSXC_DATABASE and KEEPASSXC_KEYFILE env vars
+    * database is unlocked only once per load and expanded config file without
+      secrets is cached in $XDG_CACHE_HOME/weechat/confload
+    * user input is only grabbed and masked while a passphrase prompt is pending
 """
-from subprocess import check_output, CalledProcessError
-from os import getenv
-from os.path import join
-from shlex import quote
+from os import getenv, makedirs, replace
+from os.path import join, dirname, expanduser
+from mmap import mmap, MADV_DONTDUMP
+from ctypes import CDLL, c_char, c_size_t, c_void_p, addressof, get_errno
+from hashlib import sha256
+from re import compile as re_compile, escape, ASCII
+from time import perf_counter, monotonic
+from tempfile import NamedTemporaryFile
 from abc import ABC
 import weechat as w # pylint: disable=import-error
 import __main__
@@ -18,28 +26,16 @@ import __main__
 DATABASE = getenv("KEEPASSXC_DATABASE", "~/database.kdbx")
 KEYFILE = getenv("KEEPASSXC_KEYFILE", "")
 TEMPLATE = join(getenv("WEECHAT_HOME", join(getenv("HOME"), ".weechat")), "weechatrc")
-
-class Confload():
-    """Preprocess config file and execute execute commands."""
-    keexc = "keepassxc-cli show --attributes $2 --key-file '{}' --quiet '{}' $1 <<< {}"
-    abort = "ifelse(eval(sysval != 0), 1, `m4exit(sysval)')dnl"
-    commands = None
-
-    def preprocess(self, password):
-        """Preprocess weechat config file."""
-        keexc = self.keexc.format(KEYFILE, DATABASE, quote(password))
-        try:
-            self.commands = check_output(["m4", "-DKEEPASS=syscmd(" + keexc + ")"
-                                          + self.abort, TEMPLATE])
-            return True
-        except CalledProcessError:
-            return False
-
-    def execute_commands(self):
-        """Execute weechat commands."""
-        for command in self.commands.splitlines():
-            if command.strip():
-                w.command("", command.decode())
+CACHE = join(getenv("XDG_CACHE_HOME", join(getenv("HOME"), ".cache")), "weechat", "confload")
+# libc is already loaded into weechat, so resolve its symbols from the process
+LIBC = CDLL(None, use_errno=True)
+# commands which set something by name and how to undo them
+UNDO = (
+    (re_compile(r"/set\s+(\S+)"), "/unset {}"),
+    (re_compile(r"/secure\s+set\s+(\S+)"), "/secure del {}"),
+    (re_compile(r"/server\s+add\s+(\S+)"), "/server del {}"),
+    (re_compile(r"/(filter|trigger|alias)\s+add(?:replace)?\s+(\S+)"), "/{} del {}"),
+)
 
 class CallbackCreator(ABC):
     """Base class used by classes who must specify weechat callbacks as strings."""
@@ -50,41 +46,514 @@ class CallbackCreator(ABC):
         setattr(__main__, name, method)
         return name
 
+class Expander():
+    """
+    Expand the subset of m4 which config files use: quotes, comments, dnl,
+    define, undefine, ifdef, ifelse and defined macros with arguments ($0-$9,
+    $#, $* and $@). Additional builtins are functions which take the list of
+    arguments of a macro call. Other m4 builtins are not supported.
+    """
+    word = re_compile(r"[A-Za-z_]\w*", ASCII)
+    quote = re_compile(r"[`']")
+    argument = re_compile(r"[`#(),]")
+    parameter = re_compile(r"\$([0-9#*@])")
+
+    def __init__(self, **builtins):
+        self.macros, self.pattern = {}, None
+        self.builtins = {"define": self.define, "undefine": self.undefine, "ifdef": self.ifdef,
+                         "ifelse": self.ifelse, **builtins}
+
+    def plain(self):
+        """
+        Regex which matches text up to the next quote, comment or macro name,
+        so that other words don't have to be looked at one by one. It has to
+        be compiled again whenever macros are defined or undefined.
+        """
+        if not self.pattern:
+            names = "|".join(map(escape, ["dnl", *self.macros, *self.builtins]))
+            self.pattern = re_compile(
+                rf"(?:[^`#A-Za-z_]+|(?!(?:{names})(?!\w))[A-Za-z_]\w*)*", ASCII)
+        return self.pattern
+
+    def expand(self, text):
+        """Expand all macros in text, the result of which is expanded again."""
+        out, pos = [], 0
+        while (start := self.plain().match(text, pos).end()) < len(text):
+            out.append(text[pos:start])
+            token = text[start] if text[start] in "`#" else self.word.match(text, start)[0]
+            pos = start + len(token)
+            if token == "`":
+                pos = self.skip_quoted(text, start)
+                out.append(text[start + 1:pos - 1])
+            elif token == "#":
+                pos = self.skip_line(text, start)
+                out.append(text[start:pos])
+            elif token == "dnl":
+                pos = self.skip_line(text, pos)
+            else:
+                args = None
+                if text.startswith("(", pos):
+                    args, pos = self.arguments(text, pos + 1)
+                if token in self.macros:
+                    out.append(self.expand(self.call(token, args or [])))
+                elif args is None: # like m4, builtins are only recognized with arguments
+                    out.append(token)
+                else:
+                    out.append(self.expand(self.builtins[token](args)))
+        out.append(text[pos:])
+        return "".join(out)
+
+    @staticmethod
+    def skip_line(text, pos):
+        """Return the position after the line at pos."""
+        end = text.find("\n", pos)
+        return len(text) if end == -1 else end + 1
+
+    def skip_quoted(self, text, pos):
+        """Return the position after the (possibly nested) quoted string at pos."""
+        depth = 0
+        for match in self.quote.finditer(text, pos):
+            depth += 1 if match[0] == "`" else -1
+            if depth == 0:
+                return match.end()
+        raise ValueError("end of file in string")
+
+    def arguments(self, text, pos):
+        """Collect and expand the arguments of a macro call up to the closing parenthesis."""
+        args, depth, start = [], 0, pos
+        while match := self.argument.search(text, pos):
+            char, pos = match[0], match.end()
+            if char == "`":
+                pos = self.skip_quoted(text, match.start())
+            elif char == "#":
+                pos = self.skip_line(text, match.start())
+            elif char == "(":
+                depth += 1
+            elif depth and char == ")":
+                depth -= 1
+            elif not depth:
+                args.append(text[start:match.start()])
+                start = pos
+                if char == ")":
+                    return [self.expand(arg.lstrip()) for arg in args], pos
+        raise ValueError("end of file in argument list")
+
+    def call(self, name, args):
+        """Substitute the arguments of a call for the parameters of a defined macro."""
+        def parameter(match):
+            if match[1] == "#":
+                return str(len(args))
+            if match[1] == "*":
+                return ",".join(args)
+            if match[1] == "@":
+                return ",".join(f"`{arg}'" for arg in args)
+            idx = int(match[1])
+            return name if idx == 0 else (args[idx - 1] if idx <= len(args) else "")
+        return self.parameter.sub(parameter, self.macros[name])
+
+    def define(self, args):
+        """Builtin which defines a macro, which expands to nothing."""
+        self.macros[args[0]], self.pattern = (args[1] if len(args) > 1 else ""), None
+        return ""
+
+    def undefine(self, args):
+        """Builtin which removes macros, which expands to nothing."""
+        for name in args:
+            self.macros.pop(name, None)
+        self.pattern = None
+        return ""
+
+    def ifdef(self, args):
+        """Builtin which expands to the second argument if the first is defined, else the third."""
+        if args[0] in self.macros or args[0] in self.builtins:
+            return args[1] if len(args) > 1 else ""
+        return args[2] if len(args) > 2 else ""
+
+    @staticmethod
+    def ifelse(args):
+        """Builtin which expands to the result of the first equal pair, else the default."""
+        if len(args) < 3:
+            return ""
+        while len(args) >= 3:
+            if args[0] == args[1]:
+                return args[2]
+            args = args[3:]
+        return args[0] if len(args) == 1 else ""
+
+class KeePassXC():
+    """
+    Backend for KEEPASS macros, which unlocks a KeePassXC database only once
+    for all secrets and only reads the referenced ones.
+    """
+
+    @staticmethod
+    def resolve(run, password, references, then):
+        """
+        Look up (title, attr) references, where title is the path of an entry
+        (without the root group), and pass a dict of their values to then. The
+        database is opened in an interactive keepassxc-cli session, which is
+        started with run, and each reference is looked up with a show command.
+        """
+        references, commands = list(references), []
+        for title, attr in references:
+            if any(char in title + attr for char in '"\n'):
+                raise ValueError(f"Can't look up {title}, {attr} with keepassxc-cli")
+            commands.append(f'show --quiet --attributes "{attr.strip()}" "{title.strip().strip("/")}"')
+
+        def parse(output):
+            # each command is preceded by the prompt of the session (and maybe
+            # echoed), and shown values end with a newline, so lookups which
+            # failed have no output at all
+            if (end := output.find("> ")) < 0:
+                raise KeyError("no interactive session")
+            outputs = output.split(output[:end + 2])[1:len(commands) + 1]
+            secrets = {}
+            for reference, command, value in zip(references, commands, outputs):
+                if not (value := value.removeprefix(command + "\n")):
+                    raise KeyError(reference)
+                secrets[reference] = value.removesuffix("\n")
+            if len(secrets) != len(references):
+                raise KeyError("session ended early")
+            then(secrets)
+
+        keyfile = ["--key-file", KEYFILE] if KEYFILE else []
+        run(["keepassxc-cli", "open", "--quiet", *keyfile, expanduser(DATABASE)], parse,
+            "".join(f"{line}\n" for line in [password, *commands, "quit"]))
+
+class SecretCache(CallbackCreator):
+    """
+    Keep resolved secrets in memory which is locked into RAM (so it is never
+    swapped to disk) and excluded from core dumps. The memory is overwritten
+    when the secrets expire or are wiped.
+    """
+    option = "secret_cache_ttl"
+    memory, address, index, expires, timer = None, None, {}, 0, None
+
+    def __init__(self):
+        self.wipe_cb_name = self.callback(self.wipe_cb)
+
+    def ttl(self):
+        """Seconds for which secrets are cached, 0 if caching is disabled."""
+        try:
+            return max(int(w.config_get_plugin(self.option) or 0), 0)
+        except ValueError:
+            return 0
+
+    def store(self, secrets):
+        """Cache secrets, a dict mapping (title, attr) references to values."""
+        self.wipe()
+        if not (ttl := self.ttl()):
+            return
+        values = [value.encode() for value in secrets.values()]
+        memory = mmap(-1, max(sum(map(len, values)), 1))
+        buffer = c_char.from_buffer(memory)
+        address = addressof(buffer)
+        del buffer
+        if LIBC.mlock(c_void_p(address), c_size_t(len(memory))) != 0:
+            memory.close()
+            raise OSError(get_errno(), "Can't lock memory for caching secrets")
+        memory.madvise(MADV_DONTDUMP)
+        for ref, value in zip(secrets, values):
+            self.index[ref] = memory.tell(), len(value)
+            memory.write(value)
+        self.memory, self.address, self.expires = memory, address, monotonic() + ttl
+        self.timer = w.hook_timer(ttl * 1000, 0, 1, self.wipe_cb_name, "")
+
+    def get(self, references):
+        """Return cached secrets for all references, or None if any are missing."""
+        if self.memory and monotonic() >= self.expires:
+            self.wipe()
+        if not self.memory or not references <= self.index.keys():
+            return None
+        return {ref: self.memory[self.index[ref][0]:sum(self.index[ref])].decode()
+                for ref in references}
+
+    def wipe(self):
+        """Overwrite and release cached secrets."""
+        if self.memory:
+            self.memory[:] = bytes(len(self.memory))
+            LIBC.munlock(c_void_p(self.address), c_size_t(len(self.memory)))
+            self.memory.close()
+        if self.timer:
+            w.unhook(self.timer)
+        self.memory, self.index, self.timer = None, {}, None
+
+    def wipe_cb(self, data, remaining_calls):
+        """Callback for timer hook which wipes secrets when they expire."""
+        self.timer = None
+        self.wipe()
+        return w.WEECHAT_RC_OK
+
+class Confload(CallbackCreator):
+    """
+    Preprocess config file and execute execute commands. Processes are run
+    asynchronously with weechat's process hooks, so that weechat stays
+    responsive in the meantime.
+    """
+    # KEEPASS macros expand to placeholders, which are replaced with secrets
+    # resolved by the backend
+    keepass = "\x1fKEEPASS\x1f{}\x1f{}\x1f"
+    placeholder = re_compile("\x1fKEEPASS\x1f(.*?)\x1f(.*?)\x1f")
+    backend = KeePassXC()
+    secrets = SecretCache()
+    commands = None
+    # weechat is global, so commands applied by any instance are shared
+    applied = {}
+
+    def __init__(self):
+        self.processes, self.done, self.uncached, self.password = {}, None, None, None
+        self.process_cb_name = self.callback(self.process_cb)
+
+    def run(self, args, then, stdin=None):
+        """Run a process without a shell and pass its output to then when it succeeded."""
+        key = str(id(then))
+        self.processes[key] = then, []
+        options = {f"arg{idx}": arg for idx, arg in enumerate(args[1:], 1)}
+        if stdin is not None:
+            options["stdin"] = "1"
+        hook = w.hook_process_hashtable(args[0], options, 0, self.process_cb_name, key)
+        if stdin is not None:
+            w.hook_set(hook, "stdin", stdin)
+            w.hook_set(hook, "stdin_close", "")
+
+    def process_cb(self, data, command, return_code, out, err):
+        """Callback for process hooks which collects output until the process ended."""
+        then, output = self.processes[data]
+        output.append(out)
+        if return_code == w.WEECHAT_HOOK_PROCESS_RUNNING:
+            return w.WEECHAT_RC_OK
+        del self.processes[data]
+        try:
+            if return_code != 0:
+                raise ChildProcessError(err)
+            then("".join(output))
+        except (OSError, KeyError):
+            self.finish(False)
+        return w.WEECHAT_RC_OK
+
+    def keepass_macro(self, args):
+        """Expand a KEEPASS macro to a placeholder for its secret."""
+        if len(args) != 2:
+            raise ValueError("KEEPASS expects a title and an attribute")
+        return self.keepass.format(*args)
+
+    def expand(self):
+        """
+        Expand config file, but without resolving KEEPASS macros. The result
+        contains no secrets, so it is cached on disk and only expanded again
+        when the config file changed.
+        """
+        with open(TEMPLATE, "rb") as template:
+            content = template.read()
+        digest = sha256(self.keepass.encode() + content).hexdigest()
+        try:
+            with open(CACHE, encoding="utf-8") as cache:
+                if cache.readline().rstrip("\n") == digest:
+                    return cache.read()
+        except OSError:
+            pass
+
+        expanded = Expander(KEEPASS=self.keepass_macro).expand(content.decode())
+        makedirs(dirname(CACHE), exist_ok=True)
+        with NamedTemporaryFile("w", encoding="utf-8", dir=dirname(CACHE), delete=False) as cache:
+            cache.write(f"{digest}\n{expanded}")
+        replace(cache.name, CACHE)
+        return expanded
+
+    def preprocess(self, password, done, uncached=None):
+        """
+        Preprocess weechat config file and call done with whether that
+        succeeded. Without a password, uncached is called instead if secrets
+        aren't cached. Returns false if preprocessing is already in progress.
+        """
+        if self.done:
+            return False
+        self.password, self.done, self.uncached = password, done, uncached
+        try:
+            self.resolve(self.expand())
+        except (OSError, ValueError, RecursionError) as error:
+            w.prnt("", "{}{}: {}".format(w.prefix("error"), TEMPLATE, error))
+            self.finish(False)
+        return True
+
+    def resolve(self, expanded):
+        """Replace the placeholders of KEEPASS macros with secrets."""
+        def substitute(secrets):
+            self.commands = self.placeholder.sub(lambda match: secrets[match[1], match[2]], expanded)
+            self.finish(True)
+
+        def cache(secrets):
+            try:
+                self.secrets.store(secrets)
+            except OSError as error:
+                w.prnt("", "{}{}".format(w.prefix("error"), error.strerror))
+            substitute(secrets)
+
+        references = set(self.placeholder.findall(expanded))
+        if (secrets := self.secrets.get(references)) is not None:
+            substitute(secrets)
+        elif self.password:
+            self.backend.resolve(self.run, self.password, references, cache)
+        elif uncached := self.uncached:
+            self.done, self.uncached = None, None
+            uncached()
+        else:
+            raise ValueError("Secrets aren't cached, passphrase required")
+
+    def finish(self, success):
+        """Forget the password and report the result of preprocessing."""
+        done, self.done, self.uncached, self.password = self.done, None, None, None
+        if done:
+            done(success)
+
+    @staticmethod
+    def undo(command):
+        """Return the command which undoes a command, if there is any."""
+        for pattern, undo in UNDO:
+            if match := pattern.match(command):
+                return undo.format(*match.groups())
+        return None
+
+    def execute_commands(self, undo_removed=False):
+        """
+        Execute weechat commands which were added or changed since the last
+        time. Commands which set something by name are identified by how to
+        undo them, so that only the last one counts, other commands by their
+        digest. If undo_removed is true, commands which are gone are undone,
+        if possible. Commands contain secrets, so only their digests are kept
+        afterwards.
+        """
+        start, commands = perf_counter(), {}
+        for command in self.commands.splitlines():
+            if command := command.strip():
+                digest = sha256(command.encode()).digest()
+                commands[self.undo(command) or digest] = command, digest
+        self.commands = None
+
+        changed = [command for key, (command, digest) in commands.items() if self.applied.get(key) != digest]
+        removed = [key for key in reversed(self.applied) if key not in commands and isinstance(key, str)]
+        for command in changed:
+            w.command("", command)
+        if undo_removed:
+            for command in removed:
+                w.command("", command)
+        Confload.applied = {key: digest for key, (_, digest) in commands.items()}
+
+        w.prnt("", "Applied {} of {} commands{} in {:.0f} ms.".format(
+            len(changed), len(commands), f", undid {len(removed)}" if undo_removed else "",
+            1000 * (perf_counter() - start)))
+
+class PasswordPrompt(CallbackCreator):
+    """
+    Prompt for the KeePassXC passphrase by grabbing and masking the next user
+    input. The modifier hooks run on every redraw, so they only exist while
+    the prompt is pending.
+    """
+    prompt = f"Enter password to unlock {DATABASE}: "
+    cursor = "b#"
+    hooks, loaded = (), None
+
+    def __init__(self, confload):
+        self.confload = confload
+        self.passwd_conceil_cb_name = self.callback(self.passwd_conceil_cb)
+        self.passwd_grab_cb_name = self.callback(self.passwd_grab_cb)
+
+    def open(self, loaded):
+        """
+        Create hooks to grab all user input to obtain KeePassXC password and
+        call loaded with whether loading the config file succeeded. A pending
+        prompt is kept as is.
+        """
+        if not self.hooks:
+            self.loaded = loaded
+            self.hooks = (
+                w.hook_modifier("input_text_display_with_cursor", self.passwd_conceil_cb_name, ""),
+                w.hook_modifier("input_text_for_buffer", self.passwd_grab_cb_name, ""))
+
+    def close(self):
+        """Remove all hooks."""
+        for hook in self.hooks:
+            w.unhook(hook)
+        self.hooks = ()
+
+    @staticmethod
+    def is_command(cmd):
+        """Check if string is a valid weechat command."""
+        return cmd[:1] == "/" and cmd[1:2] != "/"
+
+    def passwd_conceil_cb(self, data, modifier, modifier_data, string):
+        """Add a prompt to notify user and mask all user input."""
+        if self.is_command(string.lstrip(self.cursor)):
+            return self.prompt + string
+        pos = string.find(self.cursor)
+        return f"{self.prompt}{'*' * pos}{self.cursor}{'*' * (len(string) - 3 - pos)}"
+
+    def passwd_grab_cb(self, data, modifier, modifier_data, string):
+        """Check if user input is a potential password and try to load config."""
+        if self.is_command(string):
+            return string
+        self.confload.preprocess(string[1:] if string[:1] == "/" else string, self.grabbed)
+        return ""
+
+    def grabbed(self, success):
+        """Close the prompt once config file was processed successfully."""
+        if success:
+            self.close()
+        self.loaded(success)
 
 class CommandAdder(CallbackCreator):
     """Add weechat command to trigger confload manually."""
-    confload = Confload()
+    undo_option = "undo_removed"
+
+    def __init__(self, confload, prompt):
+        self.confload, self.prompt = confload, prompt
 
     def add_command(self):
         """Add command and create callbacks."""
         name = "confload"
-        desc = "Load $WEECHAT_HOME/weechatrc. Expects KeePassXC passphrase"
-        args = "<passphrase>"
+        desc = ("Load $WEECHAT_HOME/weechatrc. Prompts for the KeePassXC passphrase, unless "
+                "secrets are cached. With -wipe, cached secrets are forgotten")
+        args = "[-wipe]"
 
         w.hook_command(name, desc, args, '', '', self.callback(self.command_cb), '')
-        w.hook_modifier("input_text_display", self.callback(self.passwd_conceil_cb), "")
+        w.config_set_desc_plugin(
+            self.undo_option,
+            "Undo commands removed from weechatrc when reloading it, if possible. (default: \"off\")")
+        w.config_set_desc_plugin(
+            SecretCache.option,
+            "Seconds to keep secrets in locked memory for reloading without passphrase, "
+            "0 to disable. (default: \"0\")")
 
-    def command_cb(self, data, buffer, password):
+    def command_cb(self, data, buffer, args):
         """Callback for command hook which triggers processing of config file."""
-        if self.confload.preprocess(password):
-            self.confload.execute_commands()
+        if args == "-wipe":
+            self.confload.secrets.wipe()
+            w.prnt("", "Forgot cached secrets.")
             return w.WEECHAT_RC_OK
-        w.prnt("", "{}Something went wrong! Maybe wrong password?".format(w.prefix("error")))
-        return w.WEECHAT_RC_ERROR
+        if args:
+            # the input bar isn't masked, so the passphrase must be entered at the prompt
+            w.prnt("", "{}Run /confload without arguments and enter the passphrase at the "
+                   "prompt.".format(w.prefix("error")))
+            return w.WEECHAT_RC_ERROR
+        if self.confload.done:
+            w.prnt("", "{}Config file is already being loaded.".format(w.prefix("error")))
+            return w.WEECHAT_RC_ERROR
+        self.confload.preprocess("", self.loaded, lambda: self.prompt.open(self.loaded))
+        return w.WEECHAT_RC_OK
 
-    def passwd_conceil_cb(self, data, modifier, modifier_data, string):
-        """Callback for hook which hides password when entering command."""
-        prefix = "/confload "
-        if string.startswith(prefix):
-            return prefix + (len(string) - len(prefix)) * "*"
-        return string
+    def loaded(self, success):
+        """Execute commands once config file was processed."""
+        if success:
+            self.confload.execute_commands(w.config_get_plugin(self.undo_option) == "on")
+        else:
+            w.prnt("", "{}Something went wrong! Maybe wrong password?".format(w.prefix("error")))
 
 class Initializer(CallbackCreator):
     """Class which initializes stuff when loading confload for the first time."""
     option = "initialized"
-    confload = Confload()
-    passwd_conceil_hook = None
-    passwd_grab_hook = None
+
+    def __init__(self, confload, prompt):
+        self.confload, self.prompt = confload, prompt
 
     @staticmethod
     def initialized():
@@ -92,50 +561,19 @@ class Initializer(CallbackCreator):
         return w.config_get_plugin(Initializer.option) == "on"
 
     def initialize(self):
-        """Create hooks to grab all user input to obtain KeePassXC password."""
+        """Prompt for the KeePassXC password to load the config file."""
         w.config_set_desc_plugin(
             self.option,
             "If not yet initialized, run once. (default: \"off\")")
-        self.passwd_conceil_hook = w.hook_modifier(
-            "input_text_display_with_cursor",
-            self.callback(self.passwd_conceil_cb),
-            "")
-        self.passwd_grab_hook = w.hook_modifier(
-            "input_text_for_buffer",
-            self.callback(self.passwd_grab_cb),
-            "")
-
-    def is_command(self, cmd):
-        """Check if string is a valid weechat command."""
-        if cmd.startswith("/") and not cmd.startswith("//"):
-            return True
-        return False
-
-    def passwd_conceil_cb(self, data, modifier, modifier_data, string):
-        """Add a prompt to notify user and mask all user input."""
-        prompt = f"Enter password to unlock {DATABASE}: "
-        cursor = "b#"
-        if self.is_command(string.lstrip(cursor)):
-            return prompt + string
-        pos = string.find(cursor)
-        return prompt + pos * "*" + cursor + (len(string) - 3 - pos) * "*"
+        self.prompt.open(self.loaded)
 
-    def passwd_grab_cb(self, data, modifier, modifier_data, string):
-        """Check if user input is a potential password and try to load config."""
-        if self.is_command(string):
-            return string
-        if self.confload.preprocess(string.replace("/", "", 1)):
+    def loaded(self, success):
+        """Execute commands and remember that confload is initialized."""
+        if success:
             self.confload.execute_commands()
-            self.cleanup_and_finish()
-            return "/input delete_line"
-        w.prnt("", "{}Something went wrong! Maybe wrong password?".format(w.prefix("error")))
-        return ""
-
-    def cleanup_and_finish(self):
-        """Remove all hooks and set a config option to remember that confload is initialized."""
-        w.unhook(self.passwd_conceil_hook)
-        w.unhook(self.passwd_grab_hook)
-        w.config_set_plugin(self.option, "on")
+            w.config_set_plugin(self.option, "on")
+        else:
+            w.prnt("", "{}Something went wrong! Maybe wrong password?".format(w.prefix("error")))
 
 def register_script():
     """Register the script for weechat."""
@@ -148,6 +586,8 @@ def register_script():
     return w.register(name, author, version, license_, desc, "", "")
 
 if __name__ == "__main__" and register_script():
+    CONFLOAD = Confload()
+    PROMPT = PasswordPrompt(CONFLOAD)
     if not Initializer.initialized():
-        Initializer().initialize()
-    CommandAdder().add_command()
+        Initializer(CONFLOAD, PROMPT).initialize()
+    CommandAdder(CONFLOAD, PROMPT).add_command()